@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+# Benchmark the ems control cycle against a local fake VictoriaMetrics (or
+# InfluxDB for the influx backend) with configurable latency, jitter and
+# errors.
+
+import argparse
+import json
+import math
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import gpiozero
+from gpiozero.pins.mock import MockFactory
+
+from ems import EMS, WINDOW_LABEL
+
+# typical inverter values, served with a little noise
+VALUES = {
+    "battery_DC_V": 26.5,
+    "battery_charging_current": 20.0,
+    "battery_discharge_current": 0.0,
+    "pv_DC_V": 70.0,
+    "pv_A": 12.0,
+    "pv_W": 800.0,
+    "pv_Wh": 0.0,
+    "out_AC_V": 230.0,
+    "out_Hz": 50.0,
+    "out_load_percent": 8.0,
+    "out_load_va": 320.0,
+    "out_load_watt": 300.0,
+    "out_load_watthour": 0.0,
+    "grid_AC_V": 0.0,
+    "grid_Hz": 0.0,
+}
+
+# complete configuration driving both loads
+BENCH_CONF = {
+    "victoria": {"url": "http://127.0.0.1", "port": 8428},
+    "influx": {
+        "host": "127.0.0.1",
+        "port": 8086,
+        "user": "ems",
+        "password": "ems",
+        "database": "ems",
+    },
+    "mean": {"short": 1, "long": 10},
+    "heater": {
+        "relay_pin": 17,
+        "state_timer": 5,
+        "off_condition": {
+            "max_daily_run": 3,
+            "timeout": 60,
+            "short": {"mean": 15, "battery_voltage_limit": 22, "load_limit": 2500},
+            "long": {
+                "mean": 10,
+                "battery_voltage_limit": 23,
+                "load_limit": 2000,
+                "input_power": 200,
+            },
+        },
+        "on_condition": {
+            "battery_voltage": 26,
+            "input_power": 400,
+            "output_power_limit": 1000,
+        },
+    },
+    "hydro": {
+        "relay_pin": 4,
+        "state_timer": 5,
+        "off_condition": {"timeout": 60, "long": {"battery_voltage_limit": 27.5}},
+        "on_condition": {
+            "battery_voltage": 23.9,
+            "input_power": 500,
+            "output_power_limit": 700,
+        },
+    },
+}
+
+
+def Value(item):
+    return VALUES.get(item, 0.0) * random.uniform(0.98, 1.02)
+
+
+class FakeServer(ThreadingHTTPServer):
+    # local stand-in for a time series database, counting what it serves
+    daemon_threads = True
+
+    def __init__(self, handler, latency=0, jitter=0, error_rate=0):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.Reset()
+
+    def Reset(self):
+        with self.lock:
+            self.requests = 0
+            self.errors = 0
+            self.bytes = 0
+
+    def Start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def Stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def Delay(self):
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def Fail(self):
+        return random.random() < self.error_rate
+
+    def Count(self, size, error=False):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            if error:
+                self.errors += 1
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, do not let delayed ACKs
+    # of keep-alive connections add to the measured latency
+    disable_nagle_algorithm = True
+
+    def Reply(self, status, body):
+        self.server.Count(len(body), status != 200)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def Handle(self, path, params):
+        # return the answer body, None for unknown paths
+        raise NotImplementedError
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.Delay()
+        if self.server.Fail():
+            self.Reply(503, b"")
+            return
+        body = self.Handle(url.path, parse_qs(url.query))
+        if body is None:
+            self.Reply(404, b"")
+        else:
+            self.Reply(200, body)
+
+    def do_POST(self):
+        # influx clients may send their queries as a form
+        length = int(self.headers.get("Content-Length", 0))
+        form = parse_qs(self.rfile.read(length).decode())
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        params.update(form)
+        self.server.Delay()
+        if self.server.Fail():
+            self.Reply(503, b"")
+            return
+        body = self.Handle(url.path, params)
+        if body is None:
+            self.Reply(404, b"")
+        else:
+            self.Reply(200, body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeVictoriaMetricsHandler(FakeHandler):
+    # answers the /api/v1/query shapes sent by ems.py and the export API
+    def Handle(self, path, params):
+        if path == "/api/v1/query":
+            return self.Query(params["query"][0])
+        if path == "/api/v1/export":
+            return self.Export(params["match[]"][0], float(params["start"][0]))
+        return None
+
+    def Query(self, query):
+        now = time.time()
+        result = []
+        match = re.search(r'__name__=~"([^"]*)"', query)
+        if match:
+            # batched query, one serie per metric and window
+            items = match.group(1).split("|")
+            windows = re.findall(r'"{}", "(\w+)"'.format(WINDOW_LABEL), query)
+            if not windows:
+                # recorded means, ems:<metric>:avg_<N>m
+                for item in items:
+                    result.append(
+                        {
+                            "metric": {"__name__": item},
+                            "value": [now, str(Value(item.split(":")[1]))],
+                        }
+                    )
+            for window in windows:
+                for item in items:
+                    result.append(
+                        {
+                            "metric": {"__name__": item, WINDOW_LABEL: window},
+                            "value": [now, str(Value(item))],
+                        }
+                    )
+        else:
+            match = re.search(r"avg_over_time\((\w+)\[", query)
+            item = match.group(1) if match else query
+            result.append(
+                {"metric": {"__name__": item}, "value": [now, str(Value(item))]}
+            )
+        return json.dumps(
+            {"status": "success", "data": {"resultType": "vector", "result": result}}
+        ).encode()
+
+    def Export(self, match, start):
+        # one sample per second since start, at most one hour of them
+        now = math.floor(time.time())
+        first = max(math.floor(start) + 1, now - 3600)
+        items = re.search(r'__name__=~"([^"]*)"', match).group(1).split("|")
+        lines = []
+        for item in items:
+            timestamps = list(range(first * 1000, now * 1000 + 1, 1000))
+            lines.append(
+                json.dumps(
+                    {
+                        "metric": {"__name__": item},
+                        "values": [Value(item) for _ in timestamps],
+                        "timestamps": timestamps,
+                    }
+                )
+            )
+        return "\n".join(lines).encode()
+
+
+class FakeInfluxHandler(FakeHandler):
+    # answers the InfluxQL statements sent by the influx backend
+    def Handle(self, path, params):
+        if path != "/query":
+            return None
+        epoch = "epoch" in params
+        results = []
+        for id, statement in enumerate(params["q"][0].split(";")):
+            if statement.strip():
+                results.append(self.Statement(id, statement.strip(), epoch))
+        return json.dumps({"results": results}).encode()
+
+    def Statement(self, id, statement, epoch=False):
+        measurement = re.search(r"FROM (\w+)", statement).group(1)
+        fields = [
+            item[len(measurement) + 1 :]
+            for item in VALUES
+            if item.startswith(measurement + "_")
+        ]
+        if epoch:
+            now = int(time.time())
+        else:
+            now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        if "MEAN(*)" in statement:
+            columns = ["mean_{}".format(field) for field in fields]
+        else:
+            # SELECT LAST(first), others... FROM measurement
+            selected = re.search(r"SELECT (.*) FROM", statement).group(1).split(",")
+            columns = [
+                "last" if column.strip().startswith("LAST(") else column.strip()
+                for column in selected
+            ]
+        values = [now]
+        for column in columns:
+            field = column[len("mean_") :] if column.startswith("mean_") else column
+            if column == "last":
+                field = fields[0]
+            values.append(Value("{}_{}".format(measurement, field)))
+        return {
+            "statement_id": id,
+            "series": [
+                {"name": measurement, "columns": ["time"] + columns, "values": [values]}
+            ],
+        }
+
+
+def Percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def LoadEms(module, conf):
+    # instantiate the EMS class of module from a conf dict
+    with tempfile.NamedTemporaryFile("w", suffix=".conf") as conffile:
+        json.dump(conf, conffile)
+        conffile.flush()
+        return module(conffile.name)
+
+
+def Bench(ems, server, cycles, check):
+    # run cycles back to back and report the cost of each of them
+    server.Reset()
+    latencies = []
+    failures = 0
+    start = time.perf_counter()
+    for _ in range(cycles):
+        begin = time.perf_counter()
+        try:
+            ems.RefreshData()
+            check()
+        except Exception:
+            failures += 1
+        latencies.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    return {
+        "cycles": cycles,
+        "failures": failures,
+        "cycles_per_sec": cycles / elapsed,
+        "p50_ms": Percentile(latencies, 50) * 1000,
+        "p99_ms": Percentile(latencies, 99) * 1000,
+        "requests_per_cycle": server.requests / cycles,
+        "bytes_per_cycle": server.bytes / cycles,
+        "server_errors": server.errors,
+    }
+
+
+def BenchVictoriaMetrics(cycles, victoria={}, mean={}, **server_args):
+    server = FakeServer(FakeVictoriaMetricsHandler, **server_args).Start()
+    try:
+        conf = json.loads(json.dumps(BENCH_CONF))
+        conf["victoria"]["port"] = server.server_address[1]
+        conf["victoria"].update(victoria)
+        conf["mean"].update(mean)
+        ems = LoadEms(EMS, conf)
+        if ems.local_mean and ems.backfill:
+            ems.BackfillWindows()
+
+        def check():
+            with ems.lock:
+                ems.CheckLoads()
+
+        return Bench(ems, server, cycles, check)
+    finally:
+        server.Stop()
+
+
+def BenchInflux(cycles, **server_args):
+    # the same control core reading InfluxDB through its backend
+    server = FakeServer(FakeInfluxHandler, **server_args).Start()
+    try:
+        conf = json.loads(json.dumps(BENCH_CONF))
+        conf["backend"] = "influx"
+        conf["influx"]["port"] = server.server_address[1]
+        ems = LoadEms(EMS, conf)
+
+        def check():
+            with ems.lock:
+                ems.CheckLoads()
+
+        return Bench(ems, server, cycles, check)
+    finally:
+        server.Stop()
+
+
+# acquisition modes of ems.py worth comparing
+MODES = {
+    "sequential": ({}, {}),
+    "concurrent": ({"concurrent": True}, {}),
+    "batch": ({"batch": True}, {}),
+    "local": ({}, {"local": True}),
+    "batch-local": ({"batch": True}, {"local": True}),
+    "incremental": ({"incremental": True}, {}),
+    "recorded": ({"recorded": True}, {}),
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--cycles", type=int, default=100)
+    parser.add_argument(
+        "-m",
+        "--mode",
+        action="append",
+        choices=list(MODES) + ["influx"],
+        help="mode to benchmark, may be repeated (default: every ems.py mode)",
+    )
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0.001, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0)
+    args = parser.parse_args()
+
+    gpiozero.Device.pin_factory = MockFactory()
+    server_args = {
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "error_rate": args.error_rate,
+    }
+    print(
+        "{:<12} {:>8} {:>10} {:>9} {:>9} {:>9} {:>11}".format(
+            "mode",
+            "failures",
+            "cycles/s",
+            "p50 ms",
+            "p99 ms",
+            "req/cycle",
+            "bytes/cycle",
+        )
+    )
+    for mode in args.mode or list(MODES):
+        if mode == "influx":
+            report = BenchInflux(args.cycles, **server_args)
+        else:
+            victoria, mean = MODES[mode]
+            report = BenchVictoriaMetrics(args.cycles, victoria, mean, **server_args)
+        print(
+            "{:<12} {:>8} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.1f} {:>11.0f}".format(
+                mode,
+                report["failures"],
+                report["cycles_per_sec"],
+                report["p50_ms"],
+                report["p99_ms"],
+                report["requests_per_cycle"],
+                report["bytes_per_cycle"],
+            )
+        )
@@ -3,22 +3,1895 @@
 import argparse
 import subprocess
 import syslog
+import sys
+import os
 import json
-from datetime import datetime, timedelta
+from datetime import datetime
 import requests
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlparse, parse_qs
 import time
 import gpiozero
 import signal
+import operator
+import math
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    import influxdb
+except ImportError:
+    # only needed by the influx backend
+    influxdb = None
+
+# metrics exported by the inverter, grouped the same way as the
+# last_*/short_mean_*/long_mean_* measurement dicts
+METRICS = {
+    "battery": [
+        "battery_DC_V",
+        "battery_charging_current",
+        "battery_discharge_current",
+    ],
+    "pv": [
+        "pv_DC_V",
+        "pv_A",
+        "pv_W",
+    ],
+    "out": [
+        "out_AC_V",
+        "out_Hz",
+        "out_load_percent",
+        "out_load_va",
+        "out_load_watt",
+    ],
+    "grid": ["grid_AC_V", "grid_Hz"],
+}
+# groups fetched on each Run cycle, grid data is useless for now
+ACQUIRED_GROUPS = ["battery", "pv", "out"]
+# label used to tag each series of the batched query with its window
+WINDOW_LABEL = "ems_window"
+
+
+WINDOWS = ["last", "short", "long"]
+OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+class Snapshot:
+    # measurements of a group for one window, allocated once and updated in
+    # place by the acquisition. Values are doubles at fixed indices, the time
+    # first then the metrics in METRICS order, and are read like a dict
+    __slots__ = ("group", "index", "values")
+
+    def __init__(self, group):
+        self.group = group
+        self.index = SNAPSHOT_INDEXES[group]
+        # no data yet: dated 1970, so the loads consider it too old
+        self.values = array("d", [math.nan] * len(self.index))
+        self.values[0] = 0
+
+    def __getitem__(self, key):
+        return self.values[self.index[key]]
+
+    def __setitem__(self, key, value):
+        self.values[self.index[key]] = value
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def get(self, key, default=None):
+        index = self.index.get(key)
+        return default if index is None else self.values[index]
+
+    def Set(self, measurements):
+        # copy a {"time": ..., metric: value} mapping, the metrics it does
+        # not hold keep their value
+        values = self.values
+        index = self.index
+        for key, value in measurements.items():
+            values[index[key]] = value
+
+    def Clear(self):
+        for index in range(len(self.values)):
+            self.values[index] = math.nan
+
+    def CopyFrom(self, snapshot):
+        self.values[:] = snapshot.values
+
+    def Copy(self):
+        snapshot = Snapshot(self.group)
+        snapshot.values[:] = self.values
+        return snapshot
+
+    def AsDict(self):
+        return {key: self.values[index] for key, index in self.index.items()}
+
+
+# index of the time and of each metric in the snapshot of a group
+SNAPSHOT_INDEXES = {
+    group: dict([("time", 0)] + [(item, index + 1) for index, item in enumerate(entry)])
+    for group, entry in METRICS.items()
+}
+
+
+def MeasurementsName(window, group):
+    # attribute of the EMS holding the measurements of a group and window
+    if window == "last":
+        return "last_{}_measurements".format(group)
+    return "{}_mean_{}_measurements".format(window, group)
+
+
+def CompileCondition(condition):
+    # compile a condition of the config into a predicate of the EMS and the
+    # list of (window, metric) it reads. A condition is either
+    #   {"metric": "out_load_watt", "window": "short", "op": ">", "value": 2500}
+    # with window one of last (default), short or long, or a combination
+    #   {"any": [condition, ...]} / {"all": [condition, ...]}
+    for combinator in ["any", "all"]:
+        if combinator not in condition:
+            continue
+        items = condition[combinator]
+        if not isinstance(items, list) or not items:
+            raise ValueError(
+                "invalid condition {}: {} needs a list of conditions".format(
+                    condition, combinator
+                )
+            )
+        compiled = [CompileCondition(item) for item in items]
+        predicates = tuple(predicate for predicate, _ in compiled)
+        dependencies = []
+        for _, items in compiled:
+            dependencies.extend(item for item in items if item not in dependencies)
+        if combinator == "any":
+
+            def predicate(ems):
+                for match in predicates:
+                    if match(ems):
+                        return True
+                return False
+
+        else:
+
+            def predicate(ems):
+                for match in predicates:
+                    if not match(ems):
+                        return False
+                return True
+
+        return predicate, dependencies
+
+    try:
+        item = condition["metric"]
+        window = condition.get("window", "last")
+        compare = OPERATORS[condition["op"]]
+        threshold = float(condition["value"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError("invalid condition {}: {}".format(condition, e))
+    group = next((group for group, entry in METRICS.items() if item in entry), None)
+    if group is None:
+        raise ValueError("invalid condition {}: unknown metric".format(condition))
+    if window not in WINDOWS:
+        raise ValueError("invalid condition {}: unknown window".format(condition))
+    name = MeasurementsName(window, group)
+
+    def predicate(ems):
+        return compare(getattr(ems, name)[item], threshold)
+
+    return predicate, [(window, item)]
+
+
+def LegacyRules(load, conf):
+    # rules equivalent to the off_condition/on_condition keys of a load, the
+    # stages given by its "rules" section do not need them
+    given = conf.get("rules", {})
+
+    def Condition(metric, window, op, path, key, required=True):
+        section = conf
+        for name in path.split("."):
+            section = section.get(name, {})
+        if key not in section:
+            if required:
+                raise ValueError("missing {}.{}".format(path, key))
+            return []
+        return [{"metric": metric, "window": window, "op": op, "value": section[key]}]
+
+    if load == "heater":
+        stages = {
+            "short": lambda: {
+                "any": Condition(
+                    "out_load_watt", "short", ">", "off_condition.short", "load_limit"
+                )
+                + Condition(
+                    "battery_DC_V",
+                    "short",
+                    "<",
+                    "off_condition.short",
+                    "battery_voltage_limit",
+                )
+            },
+            "long": lambda: {
+                "any": Condition(
+                    "out_load_watt", "long", ">", "off_condition.long", "load_limit"
+                )
+                + Condition(
+                    "battery_DC_V",
+                    "long",
+                    "<",
+                    "off_condition.long",
+                    "battery_voltage_limit",
+                )
+                + Condition("pv_W", "long", "<", "off_condition.long", "input_power")
+            },
+            # output_power_limit was never required from the heater
+            "on": lambda: {
+                "all": Condition(
+                    "battery_DC_V", "last", ">", "on_condition", "battery_voltage"
+                )
+                + Condition("pv_W", "last", ">", "on_condition", "input_power")
+                + Condition(
+                    "out_load_watt",
+                    "last",
+                    "<",
+                    "on_condition",
+                    "output_power_limit",
+                    required=False,
+                )
+            },
+        }
+    elif load == "hydro":
+        stages = {
+            "long": lambda: {
+                "any": Condition(
+                    "battery_DC_V",
+                    "long",
+                    ">",
+                    "off_condition.long",
+                    "battery_voltage_limit",
+                )
+            },
+            "on": lambda: {
+                "any": Condition(
+                    "battery_DC_V", "last", "<", "on_condition", "battery_voltage"
+                )
+                + Condition("pv_W", "last", "<", "on_condition", "input_power")
+                + Condition(
+                    "out_load_watt", "last", ">", "on_condition", "output_power_limit"
+                )
+            },
+        }
+    else:
+        # other loads are only described by their rules
+        if "on" not in given:
+            raise ValueError("load {} has no on rule".format(load))
+        stages = {}
+    return {stage: rule() for stage, rule in stages.items() if stage not in given}
+
+
+def Never(ems):
+    # predicate of the trip stages a load does not have
+    return False
+
+
+def CompileRules(load, conf):
+    # compile the rules of a load, the "rules" section of its config
+    # overrides the rules derived from its off_condition/on_condition
+    rules = LegacyRules(load, conf)
+    rules.update(conf.get("rules", {}))
+    compiled = {"short": (Never, []), "long": (Never, [])}
+    compiled.update(
+        (stage, CompileCondition(condition)) for stage, condition in rules.items()
+    )
+    return compiled
+
+
+class ConfigError(ValueError):
+    pass
+
+
+# backends the measurements may be read from
+BACKENDS = ["victoria", "influx"]
+# marks the options without default value
+REQUIRED = object()
+KINDS = {bool: "a boolean", int: "an integer", float: "a number", str: "a string"}
+
+
+def Section(conf, key, path="", required=False):
+    # sub section of conf, an empty one when it is optional and missing
+    name = "{}.{}".format(path, key) if path else key
+    section = conf.get(key)
+    if section is None:
+        if required:
+            raise ConfigError("{}: missing section".format(name))
+        return {}
+    if not isinstance(section, dict):
+        raise ConfigError("{}: expected a section, got {!r}".format(name, section))
+    return section
+
+
+def Keys(conf, allowed, path):
+    # reject the keys of a section which are not in allowed
+    for key in conf:
+        if key not in allowed:
+            raise ConfigError("{}: unknown option {}".format(path, key))
+
+
+def Option(conf, key, kind, default=REQUIRED, path="", positive=False):
+    # value of conf[key] converted to kind, numbers may be given as strings.
+    # positive numbers must be greater than zero
+    name = "{}.{}".format(path, key) if path else key
+    if key not in conf:
+        if default is REQUIRED:
+            raise ConfigError("{}: missing".format(name))
+        return default
+    value = conf[key]
+    try:
+        if kind is bool:
+            if not isinstance(value, bool):
+                raise ValueError(value)
+            return value
+        if isinstance(value, (bool, dict, list)):
+            raise ValueError(value)
+        if kind is int and isinstance(value, float) and not value.is_integer():
+            raise ValueError(value)
+        converted = kind(value)
+    except (TypeError, ValueError):
+        raise ConfigError(
+            "{}: expected {}, got {!r}".format(name, KINDS[kind], value)
+        ) from None
+    if positive and not converted > 0:
+        raise ConfigError(
+            "{}: expected a positive number, got {!r}".format(name, value)
+        )
+    return converted
+
+
+# keys of the off_condition/on_condition sections of the heater and hydro
+LEGACY_KEYS = {
+    "heater": {
+        "short": ["mean", "load_limit", "battery_voltage_limit"],
+        "long": ["mean", "load_limit", "battery_voltage_limit", "input_power"],
+        "on_condition": ["battery_voltage", "input_power", "output_power_limit"],
+    },
+    "hydro": {
+        "long": ["mean", "battery_voltage_limit"],
+        "on_condition": ["battery_voltage", "input_power", "output_power_limit"],
+    },
+}
+
+
+class LoadConf:
+    # settings of a load, converted once so the checks only read attributes
+    __slots__ = (
+        "name",
+        "relay_pin",
+        "priority",
+        "power",
+        "state_timer",
+        "dwell",
+        "timeout",
+        "max_daily_run",
+        "daily_run_limit",
+        "rules",
+    )
+
+    def __init__(self, name, conf):
+        self.name = name
+        self.relay_pin = Option(conf, "relay_pin", int, path=name)
+        self.priority = Option(conf, "priority", int, 0, name)
+        self.power = Option(conf, "power", float, 0.0, name)
+        # minutes a stopped load waits before starting again
+        self.state_timer = Option(conf, "state_timer", int, path=name)
+        self.dwell = self.state_timer * 60.0
+        off_condition = Section(conf, "off_condition", name)
+        path = "{}.off_condition".format(name)
+        legacy = LEGACY_KEYS.get(name, {})
+        windows = [window for window in WINDOWS if window in legacy]
+        Keys(off_condition, ["timeout", "max_daily_run"] + windows, path)
+        for window in windows:
+            Keys(
+                Section(off_condition, window, path),
+                legacy[window],
+                path + "." + window,
+            )
+        if legacy:
+            Keys(
+                Section(conf, "on_condition", name),
+                legacy["on_condition"],
+                name + ".on_condition",
+            )
+        # seconds
+        self.timeout = float(
+            Option(off_condition, "timeout", int, 60, path, positive=True)
+        )
+        # hours, None for no limit
+        self.max_daily_run = Option(off_condition, "max_daily_run", float, None, path)
+        self.daily_run_limit = (
+            None if self.max_daily_run is None else self.max_daily_run * 3600
+        )
+        try:
+            self.rules = CompileRules(name, conf)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ConfigError("{}: invalid rules, {}".format(name, e)) from None
+
+
+class Config:
+    # typed ems.conf, validated and converted once at startup
+    __slots__ = (
+        "backend",
+        "url",
+        "influx",
+        "mean",
+        "local_mean",
+        "backfill",
+        "batch",
+        "concurrent",
+        "deadline",
+        "incremental",
+        "recorded",
+        "recorded_max_age",
+        "timeout",
+        "pool_size",
+        "period",
+        "safety_period",
+        "push",
+        "metrics",
+        "metrics_push",
+        "metrics_job",
+        "verify_period",
+        "reserve",
+        "log_size",
+        "log_interval",
+        "log_console",
+        "log_syslog",
+        "journal",
+        "loads",
+    )
+
+    def __init__(self, conf):
+        if not isinstance(conf, dict):
+            raise ConfigError("expected a JSON object, got {!r}".format(conf))
+        # database the measurements are read from, influx for the confs of
+        # ems-influx.py which only have an influx section
+        default = "victoria"
+        if conf.get("victoria") is None and "influx" in conf:
+            default = "influx"
+        self.backend = Option(conf, "backend", str, default)
+        if self.backend not in BACKENDS:
+            raise ConfigError(
+                "backend: expected one of {}, got {!r}".format(
+                    ", ".join(BACKENDS), self.backend
+                )
+            )
+        victoria = Section(conf, "victoria", required=self.backend == "victoria")
+        # VictoriaMetrics also receives the instrumentation when set
+        self.url = None
+        if victoria:
+            self.url = "{}:{}".format(
+                Option(victoria, "url", str, path="victoria"),
+                Option(victoria, "port", int, path="victoria"),
+            )
+        self.influx = None
+        if self.backend == "influx":
+            influx = Section(conf, "influx", required=True)
+            self.influx = (
+                Option(influx, "host", str, "localhost", "influx"),
+                Option(influx, "port", int, 8086, "influx"),
+                Option(influx, "user", str, "root", "influx"),
+                Option(influx, "password", str, "root", "influx"),
+                Option(influx, "database", str, path="influx"),
+                Option(influx, "timeout", float, 5.0, "influx", positive=True),
+            )
+        self.batch = Option(victoria, "batch", bool, False, "victoria")
+        self.concurrent = Option(victoria, "concurrent", bool, False, "victoria")
+        self.deadline = Option(
+            victoria, "deadline", float, 1.5, "victoria", positive=True
+        )
+        self.incremental = Option(victoria, "incremental", bool, False, "victoria")
+        self.recorded = Option(victoria, "recorded", bool, False, "victoria")
+        self.recorded_max_age = Option(
+            victoria, "recorded_max_age", float, 180.0, "victoria", positive=True
+        )
+        self.timeout = (
+            Option(victoria, "connect_timeout", float, 1.0, "victoria", positive=True),
+            Option(victoria, "read_timeout", float, 5.0, "victoria", positive=True),
+        )
+        self.pool_size = Option(
+            victoria, "pool_size", int, 4, "victoria", positive=True
+        )
+
+        # seconds of each mean window, given in minutes
+        self.mean = None
+        mean = Section(conf, "mean")
+        if "mean" in conf:
+            self.mean = {
+                window: Option(mean, window, int, path="mean", positive=True) * 60
+                for window in ["short", "long"]
+            }
+        elif "heater" in conf:
+            # confs of the former ems-influx.py: the short window in seconds
+            # and the long one in minutes of the heater off conditions
+            off_condition = Section(Section(conf, "heater"), "off_condition")
+            path = "heater.off_condition"
+            short = Section(off_condition, "short", path)
+            long = Section(off_condition, "long", path)
+            if "mean" in short and "mean" in long:
+                self.mean = {
+                    "short": Option(
+                        short, "mean", int, path=path + ".short", positive=True
+                    ),
+                    "long": Option(
+                        long, "mean", int, path=path + ".long", positive=True
+                    )
+                    * 60,
+                }
+        if self.mean is None:
+            raise ConfigError("mean: missing section")
+        self.local_mean = Option(mean, "local", bool, False, "mean")
+        self.backfill = Option(mean, "backfill", bool, True, "mean")
+
+        scheduler = Section(conf, "scheduler")
+        self.period = Option(
+            scheduler, "period", float, 2.0, "scheduler", positive=True
+        )
+        self.safety_period = Option(
+            scheduler, "safety_period", float, None, "scheduler", positive=True
+        )
+
+        self.push = None
+        if "push" in conf:
+            push = Section(conf, "push")
+            self.push = (
+                Option(push, "address", str, "127.0.0.1", "push"),
+                Option(push, "port", int, 8089, "push"),
+            )
+        instrumentation = Section(conf, "instrumentation")
+        # (address, port) of the /metrics listener, None for no listener
+        self.metrics = None
+        if "port" in instrumentation:
+            self.metrics = (
+                Option(instrumentation, "address", str, "127.0.0.1", "instrumentation"),
+                Option(instrumentation, "port", int, path="instrumentation"),
+            )
+        # seconds between two pushes to VictoriaMetrics, None for no push
+        self.metrics_push = Option(
+            instrumentation,
+            "push_period",
+            float,
+            None,
+            "instrumentation",
+            positive=True,
+        )
+        if self.metrics_push is not None and self.url is None:
+            raise ConfigError("instrumentation.push_period: needs a victoria section")
+        self.metrics_job = Option(instrumentation, "job", str, "ems", "instrumentation")
+        self.verify_period = Option(
+            Section(conf, "relay"), "verify_period", float, 60.0, "relay", positive=True
+        )
+        self.reserve = Option(
+            Section(conf, "allocation"), "reserve", float, 0.0, "allocation"
+        )
+        logging = Section(conf, "logging")
+        self.log_size = Option(
+            logging, "queue_size", int, 1000, "logging", positive=True
+        )
+        self.log_interval = Option(logging, "dedup_interval", float, 60.0, "logging")
+        self.log_console = Option(logging, "console", bool, False, "logging")
+        self.log_syslog = Option(logging, "syslog", bool, True, "logging")
+        # (path, checkpoint, compact) of the state journal, None to keep the
+        # state in memory only
+        self.journal = None
+        if "journal" in conf:
+            journal = Section(conf, "journal")
+            self.journal = (
+                Option(journal, "path", str, path="journal"),
+                Option(journal, "checkpoint", float, 300.0, "journal", positive=True),
+                Option(journal, "compact", int, 1000, "journal", positive=True),
+            )
+
+        # heater and hydro keep their own section, then the loads list
+        self.loads = [
+            LoadConf(name, Section(conf, name))
+            for name in ["heater", "hydro"]
+            if name in conf
+        ]
+        loads = conf.get("loads", [])
+        if not isinstance(loads, list):
+            raise ConfigError("loads: expected a list, got {!r}".format(loads))
+        for index, load in enumerate(loads):
+            path = "loads[{}]".format(index)
+            if not isinstance(load, dict):
+                raise ConfigError("{}: expected a section".format(path))
+            name = Option(load, "name", str, path=path)
+            if name in [known.name for known in self.loads]:
+                raise ConfigError("{}: duplicated load {}".format(path, name))
+            self.loads.append(LoadConf(name, load))
+
+
+def LoadConfig(path):
+    # read and validate a config file, return the raw dict and its Config
+    with open(path, "r") as jsonfile:
+        try:
+            conf = json.load(jsonfile)
+        except ValueError as e:
+            raise ConfigError("{}: invalid JSON, {}".format(path, e)) from None
+    return conf, Config(conf)
+
+
+def Duration(seconds):
+    # PromQL and InfluxQL duration of seconds, in minutes when whole
+    if seconds % 60 == 0:
+        return "{}m".format(seconds // 60)
+    return "{}s".format(seconds)
+
+
+def RecordedName(item, seconds):
+    # series recorded by vmalert for the mean of item over seconds
+    return "ems:{}:avg_{}".format(item, Duration(seconds))
+
+
+def Dependencies(config):
+    # (window, metric) read by the rules of the loads, and by the PV surplus
+    # allocation when a load has a power rating
+    dependencies = []
+    for load in config.loads:
+        for _, items in load.rules.values():
+            dependencies.extend(item for item in items if item not in dependencies)
+    if any(load.power > 0 for load in config.loads):
+        for item in [("short", "pv_W"), ("short", "out_load_watt")]:
+            if item not in dependencies:
+                dependencies.append(item)
+    return dependencies
+
+
+def MeanDependencies(config):
+    # the means of Dependencies
+    return [item for item in Dependencies(config) if item[0] != "last"]
+
+
+def DatingMetrics(config):
+    # {group: metrics dating it} of the acquired groups: a group is as old as
+    # the oldest metric the rules read, or its first metric when none is
+    # read, a stale unread metric does not time the loads out
+    read = {item for _, item in Dependencies(config)}
+    return {
+        group: [item for item in METRICS[group] if item in read] or METRICS[group][:1]
+        for group in ACQUIRED_GROUPS
+    }
+
+
+def FetchPlan(config):
+    # {(window, group): [metric]} to fetch each cycle, in METRICS order: the
+    # Dependencies of the config, plus the first metric of every acquired
+    # group without last value read so the data timeout still watches it
+    dependencies = set(Dependencies(config))
+    plan = {}
+    for window in WINDOWS:
+        for group, entry in METRICS.items():
+            items = [item for item in entry if (window, item) in dependencies]
+            if window == "last" and group in ACQUIRED_GROUPS and not items:
+                items = entry[:1]
+            if items:
+                plan[window, group] = items
+    return plan
+
+
+def RecordingRules(config, interval=None):
+    # vmalert recording rules of the means the loads read, as YAML
+    lines = ["groups:", "  - name: ems"]
+    if interval is not None:
+        lines.append("    interval: {}".format(interval))
+    lines.append("    rules:")
+    recorded = set()
+    for window, item in MeanDependencies(config):
+        seconds = config.mean[window]
+        if (item, seconds) in recorded:
+            continue
+        recorded.add((item, seconds))
+        lines.append("      - record: {}".format(RecordedName(item, seconds)))
+        lines.append(
+            "        expr: avg_over_time({}[{}])".format(item, Duration(seconds))
+        )
+    return "\n".join(lines) + "\n"
+
+
+class Clock:
+    # time source of the control core: monotonic seconds for durations and
+    # dwell timers, wall time for the daily reset and the age of samples.
+    # Tests and replays give their own to run at any speed
+    def Monotonic(self):
+        return time.monotonic()
+
+    def Time(self):
+        return time.time()
+
+    def Now(self):
+        return datetime.now()
+
+    def Sleep(self, duration):
+        time.sleep(duration)
+
+
+class Logger:
+    # syslog and console output kept off the control thread: Log only formats
+    # and queues the message, a writer thread started on demand writes the
+    # queue in batches. The queue is bounded, a full queue drops the message
+    # rather than blocking a relay decision. Messages given a key are rate
+    # limited, repeats of the key within interval seconds are counted and
+    # reported with the next message written for it
+    # writer thread exits after this many idle seconds
+    IDLE = 5
+    # forget the expired keys past this many keys
+    KEYS = 1024
+
+    def __init__(
+        self,
+        instrumentation,
+        size=1000,
+        interval=60,
+        console=False,
+        to_syslog=True,
+        clock=time.monotonic,
+    ):
+        self.instrumentation = instrumentation
+        self.size = size
+        self.interval = interval
+        self.console = console
+        self.to_syslog = to_syslog
+        self.clock = clock
+        self.lock = threading.Lock()
+        # held while a batch is written, keeps the batches in order
+        self.writing = threading.Lock()
+        self.event = threading.Event()
+        self.queue = deque()
+        # key: [time of the last written message, repeats suppressed since]
+        self.seen = {}
+        self.writer = None
+
+    def Log(self, priority, message, key=None, **fields):
+        if not (self.to_syslog or self.console):
+            return
+        if fields:
+            message += "".join(
+                " {}={}".format(name, value) for name, value in fields.items()
+            )
+        with self.lock:
+            if key is not None:
+                now = self.clock()
+                seen = self.seen.get(key)
+                if seen is not None and now - seen[0] < self.interval:
+                    seen[1] += 1
+                    self.instrumentation.Inc("ems_log_suppressed_total")
+                    return
+                if seen is not None and seen[1]:
+                    message += " (repeated {} times)".format(seen[1])
+                self.seen[key] = [now, 0]
+                if len(self.seen) > self.KEYS:
+                    self.seen = {
+                        name: entry
+                        for name, entry in self.seen.items()
+                        if now - entry[0] < self.interval
+                    }
+            if len(self.queue) >= self.size:
+                self.instrumentation.Inc("ems_log_dropped_total")
+                return
+            self.queue.append((priority, message))
+            if self.writer is None:
+                self.writer = threading.Thread(
+                    target=self.Write, name="ems-log", daemon=True
+                )
+                self.writer.start()
+        self.event.set()
+
+    def Drain(self):
+        with self.lock:
+            self.event.clear()
+            batch = list(self.queue)
+            self.queue.clear()
+        return batch
+
+    def Emit(self, batch):
+        # write a batch to the sinks
+        if self.to_syslog:
+            for priority, message in batch:
+                syslog.syslog(priority, message)
+        if self.console:
+            sys.stdout.write("".join(message + "\n" for _, message in batch))
+            sys.stdout.flush()
+
+    def Write(self):
+        # writer thread, exits once idle, Log starts a new one when needed
+        while True:
+            self.event.wait(self.IDLE)
+            with self.writing:
+                with self.lock:
+                    if not self.queue:
+                        self.writer = None
+                        return
+                batch = self.Drain()
+                self.Emit(batch)
+                self.instrumentation.Inc("ems_log_written_total", len(batch))
+
+    def Flush(self):
+        # write the queued messages from the calling thread
+        with self.writing:
+            batch = self.Drain()
+            if batch:
+                self.Emit(batch)
+                self.instrumentation.Inc("ems_log_written_total", len(batch))
+
+
+class Journal:
+    # append-only journal of the load states, so a restart keeps the daily
+    # runtime and dwell timers of the loads. A record is one JSON line
+    # appended on each relay transition and every checkpoint seconds while
+    # a load runs, without fsync to spare the SD card. The journal is
+    # rewritten with the last record of each load at startup and every
+    # compact records
+    def __init__(self, path, checkpoint=300, compact=1000):
+        self.path = path
+        self.checkpoint = checkpoint
+        self.compact = compact
+        self.fd = None
+        # last record of each load
+        self.states = self.Read()
+        self.Compact()
+
+    def Read(self):
+        states = {}
+        try:
+            with open(self.path, "r") as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                        states[record["load"]] = record
+                    except (ValueError, KeyError, TypeError):
+                        # line torn by a crash
+                        continue
+        except FileNotFoundError:
+            pass
+        return states
+
+    def Compact(self):
+        # replace the journal by the last records, atomically
+        temp = "{}.tmp".format(self.path)
+        with open(temp, "w") as journal:
+            for record in self.states.values():
+                journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temp, self.path)
+        self.close()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.records = len(self.states)
+
+    def Append(self, record):
+        self.states[record["load"]] = record
+        os.write(self.fd, (json.dumps(record, separators=(",", ":")) + "\n").encode())
+        self.records += 1
+        if self.records >= self.compact:
+            self.Compact()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Relay:
+    # relay output which only drives the pin when the commanded state
+    # changes. The pin is read back every verify_period seconds and written
+    # again if it does not match the commanded state anymore
+    def __init__(
+        self,
+        name,
+        pin,
+        instrumentation,
+        verify_period=60,
+        clock=time.monotonic,
+        logger=None,
+    ):
+        self.name = name
+        self.instrumentation = instrumentation
+        self.logger = logger or Logger(instrumentation)
+        self.verify_period = verify_period
+        self.clock = clock
+        # Triggered by the output pin going low: active_high=False
+        # Initially off: initial_value=False
+        self.device = gpiozero.OutputDevice(pin, active_high=False, initial_value=False)
+        self.state = False
+        self.verified = clock()
+
+    def Write(self, state):
+        with self.instrumentation.Timer(
+            "ems_relay_write_duration_seconds",
+            relay=self.name,
+            state="on" if state else "off",
+        ):
+            if state:
+                self.device.on()
+            else:
+                self.device.off()
+        self.instrumentation.Inc("ems_relay_writes_total", relay=self.name)
+        self.state = state
+        self.verified = self.clock()
+
+    def Verify(self):
+        # read the pin back, write it again if it drifted
+        self.instrumentation.Inc("ems_relay_reads_total", relay=self.name)
+        self.verified = self.clock()
+        if bool(self.device.value) == self.state:
+            return
+        self.logger.Log(
+            syslog.LOG_WARNING,
+            "ems: relay {} drifted, setting it {} again".format(
+                self.name, "on" if self.state else "off"
+            ),
+            key="drift:{}".format(self.name),
+        )
+        self.instrumentation.Inc("ems_relay_corrections_total", relay=self.name)
+        self.Write(self.state)
+
+    def Set(self, state):
+        if state != self.state:
+            self.Write(state)
+        elif self.clock() - self.verified >= self.verify_period:
+            self.Verify()
+
+    def on(self):
+        self.Set(True)
+
+    def off(self):
+        self.Set(False)
+
+    @property
+    def value(self):
+        return self.device.value
+
+    def close(self):
+        self.device.close()
+
+
+class Load:
+    # a load driven by a relay. Every load shares the same state machine:
+    #   - a running load is stopped when the data gets too old, its daily run
+    #     is reached or its short/long rules match
+    #   - a stopped load is started when it was off for state_timer minutes,
+    #     its daily run is not reached and its on rule matches
+    # Loads with a power rating also need enough PV surplus to run, see
+    # EMS.CheckLoads. The state dict is the one exposed as EMS.heater and
+    # EMS.hydro. The EMS is given to the checks rather than kept, so the
+    # relay is released with the EMS. With a journal, the state is recorded
+    # on each transition and restored from the journal at startup.
+    def __init__(
+        self,
+        conf,
+        instrumentation,
+        verify_period=60,
+        clock=None,
+        logger=None,
+        journal=None,
+    ):
+        # conf is the LoadConf of the load
+        self.conf = conf
+        self.name = conf.name
+        self.instrumentation = instrumentation
+        self.logger = logger or Logger(instrumentation)
+        self.clock = clock or Clock()
+        self.priority = conf.priority
+        self.power = conf.power
+        self.state = {
+            "enable": True,
+            "rules": conf.rules,
+            "on": False,
+        }
+        self.Reset()
+        self.journal = journal
+        self.recorded = self.clock.Monotonic()
+        if journal is not None and self.name in journal.states:
+            self.Restore(journal.states[self.name])
+        self.relay = Relay(
+            conf.name,
+            conf.relay_pin,
+            instrumentation,
+            verify_period,
+            self.clock.Monotonic,
+            self.logger,
+        )
+
+    def Reset(self):
+        # timers of a stopped load which may start right away
+        now = self.clock.Monotonic()
+        # running time of the day, in seconds
+        self.state["heating_time_counter"] = float(0)
+        # wall time of the last daily reset
+        self.state["heating_time_reset"] = self.clock.Now()
+        # monotonic time of the last state change
+        self.state["timer"] = now - self.conf.dwell
+        self.run_timer = now
+
+    def Record(self):
+        # journal the state, the monotonic times as wall times so they
+        # survive a restart
+        if self.journal is None:
+            return
+        now = self.clock.Monotonic()
+        wall = self.clock.Time()
+        counter = self.state["heating_time_counter"]
+        if self.state["on"]:
+            counter += now - self.run_timer
+        self.journal.Append(
+            {
+                "load": self.name,
+                "time": wall,
+                "on": self.state["on"],
+                "counter": counter,
+                "reset": self.state["heating_time_reset"].timestamp(),
+                "timer": wall - (now - self.state["timer"]),
+            }
+        )
+        self.recorded = now
+
+    def Restore(self, record):
+        # state of a journal record, the relay starts off so a load running
+        # when the record was written only keeps its runtime until then
+        now = self.clock.Monotonic()
+        wall = self.clock.Time()
+        try:
+            self.state["heating_time_counter"] = float(record["counter"])
+            self.state["heating_time_reset"] = datetime.fromtimestamp(record["reset"])
+            self.state["timer"] = now - max(0.0, wall - record["timer"])
+        except (KeyError, TypeError, ValueError) as e:
+            self.Reset()
+            self.logger.Log(
+                syslog.LOG_WARNING,
+                "ems: invalid journal record of {} {}".format(self.name, e),
+            )
+
+    def DailyRunReached(self):
+        limit = self.conf.daily_run_limit
+        return limit is not None and limit < self.state["heating_time_counter"]
+
+    def Start(self):
+        started = not self.state["on"]
+        if started:
+            self.run_timer = self.clock.Monotonic()
+        self.state["on"] = True
+        self.relay.on()
+        if started:
+            self.Record()
+
+    def Stop(self):
+        stopped = self.state["on"]
+        if stopped:
+            self.state["heating_time_counter"] += (
+                self.clock.Monotonic() - self.run_timer
+            )
+        self.state["on"] = False
+        self.relay.off()
+        if stopped:
+            self.Record()
+
+    def Fields(self, ems, reason):
+        # context of a decision, appended to its log message
+        return {
+            "load": self.name,
+            "reason": reason,
+            "battery_V": ems.last_battery_measurements.get("battery_DC_V"),
+            "load_W": ems.last_out_measurements.get("out_load_watt"),
+            "pv_W": ems.last_pv_measurements.get("pv_W"),
+        }
+
+    def Trip(self, reason):
+        # stop the load and restart its dwell timer
+        self.state["timer"] = self.clock.Monotonic()
+        self.Stop()
+        self.instrumentation.Inc("ems_load_trips_total", load=self.name, reason=reason)
+
+    def StopOn(self, ems, stage):
+        # stop the load if the rule of stage matches
+        rule = self.conf.rules[stage]
+        if not rule[0](ems):
+            return False
+        self.Trip(stage)
+        self.logger.Log(
+            syslog.LOG_INFO,
+            "ems: {} condition match, turning off {}. {}".format(
+                stage, self.name, ems.DescribeRule(rule)
+            ),
+            **self.Fields(ems, stage),
+        )
+        return True
+
+    def CheckSafety(self, ems, now=None):
+        # off conditions of a running load which only need the last values
+        # and short means, return True if the load was stopped. now is the
+        # wall time the samples are aged from
+        if now is None:
+            now = self.clock.Time()
+        deadline = now - self.conf.timeout
+
+        # if last grid value to old power off
+        if (
+            ems.last_battery_measurements["time"] < deadline
+            or ems.last_pv_measurements["time"] < deadline
+            or ems.last_out_measurements["time"] < deadline
+        ):
+            date = [
+                datetime.fromtimestamp(ems.last_battery_measurements["time"]),
+                datetime.fromtimestamp(ems.last_pv_measurements["time"]),
+                datetime.fromtimestamp(ems.last_out_measurements["time"]),
+            ]
+            self.Trip("deadline")
+            self.logger.Log(
+                syslog.LOG_WARNING,
+                "ems: deadline condition match, turning off {}. No data incoming since {}".format(
+                    self.name, date
+                ),
+                **self.Fields(ems, "deadline"),
+            )
+            return True
+
+        # if run more than X hours per stop
+        if self.DailyRunReached():
+            self.Trip("max_daily_run")
+            self.logger.Log(
+                syslog.LOG_INFO,
+                "ems: Max daily run reached, turning off {}. Running time: {}".format(
+                    self.name, self.state["heating_time_counter"]
+                ),
+                **self.Fields(ems, "max_daily_run"),
+            )
+            return True
+
+        # if short condition match, trigger power off
+        return self.StopOn(ems, "short")
+
+    def Check(self, ems, budget=None):
+        # run the state machine of the load, budget is the PV surplus left
+        # by the loads of higher priority (None to ignore power ratings).
+        # Return the surplus left to the next loads
+        wall = self.clock.Now()
+        state = self.state
+        budgeted = budget is not None and self.power > 0
+
+        # reset running timer counter
+        if state["heating_time_reset"].date() != wall.date():
+            self.logger.Log(
+                syslog.LOG_INFO,
+                "ems: reset max daily {} run counter. Running time: {}".format(
+                    self.name, state["heating_time_counter"]
+                ),
+            )
+            state["heating_time_counter"] = float(0)
+            state["heating_time_reset"] = wall
+            self.Record()
+
+        if state["on"]:
+            # bound the runtime a crash can lose
+            if (
+                self.journal is not None
+                and self.clock.Monotonic() - self.recorded >= self.journal.checkpoint
+            ):
+                self.Record()
+            if self.CheckSafety(ems, wall.timestamp()):
+                return budget
+            # if long condition match, trigger power off
+            if self.StopOn(ems, "long"):
+                return budget
+            # shed the load when the surplus does not cover it anymore
+            if budgeted and self.power > budget:
+                self.Trip("surplus")
+                self.logger.Log(
+                    syslog.LOG_INFO,
+                    "ems: not enough surplus, turning off {}. Surplus: {}, Power: {}".format(
+                        self.name, budget, self.power
+                    ),
+                    **self.Fields(ems, "surplus"),
+                )
+                return budget
+
+        now = self.clock.Monotonic()
+        deadline = now - self.conf.dwell
+
+        # if off more than X minutes we try to start the load and daily run
+        # not reached
+        if not state["on"] and state["timer"] < deadline and not self.DailyRunReached():
+            rule = self.conf.rules["on"]
+            if (not budgeted or self.power <= budget) and rule[0](ems):
+                self.logger.Log(
+                    syslog.LOG_INFO,
+                    "ems: start condition match, turning on {}. {}".format(
+                        self.name, ems.DescribeRule(rule)
+                    ),
+                    **self.Fields(ems, "on"),
+                )
+                state["timer"] = now
+                self.Start()
+                return budget - self.power if budgeted else budget
+
+        # If no condition was match, ensure current config is apply
+        if state["on"]:
+            self.Start()
+            if budgeted:
+                return budget - self.power
+        else:
+            self.Stop()
+        return budget
+
+
+class RollingMean:
+    # mean of the samples received during the last `window` seconds, kept
+    # as a running sum so adding a sample and reading the mean are O(1)
+    # whatever the window length
+    # recompute the running sum from the samples after this many updates to
+    # drop the float error accumulated by the additions and subtractions
+    RESYNC = 100000
+
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()
+        self.sum = float(0)
+        self.last = None
+        self.updates = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def Add(self, timestamp, value):
+        # samples are expected in order, already known ones are ignored
+        if self.last is not None and timestamp <= self.last:
+            return False
+        self.samples.append((timestamp, value))
+        self.sum += value
+        self.last = timestamp
+        self.updates += 1
+        self.Evict(timestamp)
+        return True
+
+    def Evict(self, now):
+        # same bounds as avg_over_time: samples in ]now - window, now]
+        limit = now - self.window
+        while self.samples and self.samples[0][0] <= limit:
+            self.sum -= self.samples.popleft()[1]
+            self.updates += 1
+        if not self.samples:
+            self.sum = float(0)
+        elif self.updates >= self.RESYNC:
+            self.sum = math.fsum(value for _, value in self.samples)
+            self.updates = 0
+
+    def Mean(self):
+        if not self.samples:
+            return None
+        return self.sum / len(self.samples)
+
+
+def ParseLineProtocol(line):
+    # parse one line of influx line protocol into its measurement, numeric
+    # fields and timestamp in nanoseconds (None when not given). String and
+    # boolean fields are ignored
+    parts = []
+    current = []
+    escaped = False
+    quoted = False
+    for char in line:
+        if escaped:
+            current.append(char)
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+            current.append(char)
+        elif char == " " and not quoted:
+            if current:
+                parts.append("".join(current))
+                current = []
+        else:
+            current.append(char)
+    if current:
+        parts.append("".join(current))
+    if len(parts) not in (2, 3):
+        raise ValueError("invalid line protocol: {}".format(line))
+
+    measurement = parts[0].split(",", 1)[0]
+    fields = {}
+    for field in parts[1].split(","):
+        key, _, value = field.partition("=")
+        if not key or not value or value[0] == '"':
+            continue
+        if value[-1] in "iu":
+            value = value[:-1]
+        try:
+            fields[key] = float(value)
+        except ValueError:
+            # boolean fields
+            continue
+    timestamp = int(parts[2]) if len(parts) == 3 else None
+    return measurement, fields, timestamp
+
+
+class PushHandler(BaseHTTPRequestHandler):
+    # influx line protocol write endpoint, the server carries the EMS
+    PRECISION = {"s": 1, "ms": 1e-3, "us": 1e-6, "u": 1e-6, "ns": 1e-9, "n": 1e-9}
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path not in ("/write", "/api/v2/write"):
+            self.send_error(404)
+            return
+        precision = parse_qs(url.query).get("precision", ["ns"])[0]
+        if precision not in self.PRECISION:
+            self.send_error(400, "unknown precision {}".format(precision))
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        samples = []
+        try:
+            now = self.server.ems.clock.Time()
+            for line in body.decode().splitlines():
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                measurement, fields, timestamp = ParseLineProtocol(line)
+                if timestamp is None:
+                    timestamp = now
+                else:
+                    timestamp = timestamp * self.PRECISION[precision]
+                for field, value in fields.items():
+                    # same naming as VictoriaMetrics influx ingestion
+                    samples.append(
+                        ("{}_{}".format(measurement, field), timestamp, value)
+                    )
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.server.ems.PushSamples(samples)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # requests are logged by the EMS, not on stderr
+        pass
+
+
+class CycleScheduler:
+    # pace a loop on a fixed period of the monotonic clock: the work time is
+    # subtracted from the wait so the period does not drift, and cycles
+    # overrun by more than a period are skipped instead of run late in a row
+    def __init__(self, period, clock=time.monotonic, sleep=time.sleep):
+        self.period = period
+        self.clock = clock
+        self.sleep = sleep
+        self.next = None
+        self.cycles = 0
+        self.missed = 0
+        self.jitter = float(0)
+        self.jitter_max = float(0)
+        self.jitter_sum = float(0)
+
+    def Wait(self):
+        # wait for the next cycle start and return how many were skipped
+        now = self.clock()
+        missed = 0
+        if self.next is None:
+            self.next = now
+        else:
+            self.next += self.period
+            if now < self.next:
+                self.sleep(self.next - now)
+            else:
+                missed = int((now - self.next) // self.period)
+                self.next += missed * self.period
+                self.missed += missed
+        self.jitter = self.clock() - self.next
+        self.jitter_max = max(self.jitter_max, self.jitter)
+        self.jitter_sum += self.jitter
+        self.cycles += 1
+        return missed
+
+    def Stats(self):
+        return {
+            "cycles": self.cycles,
+            "missed": self.missed,
+            "jitter": self.jitter,
+            "jitter_max": self.jitter_max,
+            "jitter_mean": self.jitter_sum / self.cycles if self.cycles else 0,
+        }
+
+
+class Histogram:
+    # cumulative histogram in the Prometheus sense, one count per bucket
+    # upper bound plus the sum and count of the observations
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = float(0)
+        self.count = 0
+
+    def Observe(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Timer:
+    # context manager observing its duration in a histogram
+    __slots__ = ("instrumentation", "histogram", "start")
+
+    def __init__(self, instrumentation, histogram):
+        self.instrumentation = instrumentation
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        with self.instrumentation.lock:
+            self.histogram.Observe(duration)
+        return False
+
+
+class Instrumentation:
+    # in memory histograms, counters and gauges of the hot path, exported
+    # at once in Prometheus text format
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def Key(self, name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def Timer(self, name, **labels):
+        key = self.Key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms.setdefault(key, Histogram())
+        return Timer(self, histogram)
+
+    def Inc(self, name, value=1, **labels):
+        key = self.Key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def Set(self, name, value, **labels):
+        self.gauges[self.Key(name, labels)] = value
+
+    def Count(self, name, value, **labels):
+        # counter totalled elsewhere, exported at its current value
+        key = self.Key(name, labels)
+        with self.lock:
+            self.counters[key] = value
+
+    def Labels(self, labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{{{}}}".format(
+            ",".join(
+                '{}="{}"'.format(
+                    key,
+                    str(value)
+                    .replace("\\", "\\\\")
+                    .replace('"', '\\"')
+                    .replace("\n", "\\n"),
+                )
+                for key, value in labels
+            )
+        )
+
+    def Export(self):
+        lines = []
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {
+                key: (list(histogram.counts), histogram.sum, histogram.count)
+                for key, histogram in self.histograms.items()
+            }
+        for kind, values in [("counter", counters), ("gauge", dict(self.gauges))]:
+            typed = set()
+            for (name, labels), value in sorted(values.items()):
+                if name not in typed:
+                    lines.append("# TYPE {} {}".format(name, kind))
+                    typed.add(name)
+                lines.append("{}{} {}".format(name, self.Labels(labels), value))
+        typed = set()
+        for (name, labels), (counts, sum, count) in sorted(histograms.items()):
+            if name not in typed:
+                lines.append("# TYPE {} histogram".format(name))
+                typed.add(name)
+            cumulative = 0
+            for bound, bucket in zip(list(Histogram.BUCKETS) + ["+Inf"], counts):
+                cumulative += bucket
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        name, self.Labels(labels, [("le", bound)]), cumulative
+                    )
+                )
+            lines.append("{}_sum{} {}".format(name, self.Labels(labels), sum))
+            lines.append("{}_count{} {}".format(name, self.Labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    # serve the instrumentation of the EMS carried by the server
+    def do_GET(self):
+        if urlparse(self.path).path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.ems.ExportInstrumentation().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AcquisitionError(Exception):
+    # raised when some acquisition groups failed, failures maps each failed
+    # group name to its error
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__(
+            "; ".join(
+                "{}: {}".format(group, error) for group, error in failures.items()
+            )
+        )
+
+
+class Backend:
+    # source of the measurements for the control core. Results are
+    # {"time": ..., metric: value} mappings keyed by the METRICS names, so
+    # the checks do not depend on the naming of the database
+    def Last(self, groups):
+        # {group: newest values of its metrics}
+        raise NotImplementedError
+
+    def Mean(self, groups, seconds):
+        # {group: mean of its metrics over the last seconds}
+        raise NotImplementedError
+
+    def Fetch(self, groups, windows, staging):
+        # fill the staging[window, group] snapshots of windows, a {window:
+        # seconds} dict where "last" asks for the newest values, and return
+        # the keys filled. Backends able to answer everything at once
+        # override it
+        keys = []
+        for window, seconds in windows.items():
+            if window == "last":
+                fetched = self.Last(groups)
+            else:
+                fetched = self.Mean(groups, seconds)
+            for group, result in fetched.items():
+                snapshot = staging[window, group]
+                snapshot.Clear()
+                snapshot.Set(result)
+                keys.append((window, group))
+        return keys
+
+    def close(self):
+        pass
+
+
+def ItemSelector(items):
+    # PromQL selector of every series of items
+    return '{{__name__=~"{}"}}'.format("|".join(items))
+
+
+class VictoriaMetrics(Backend):
+    # VictoriaMetrics HTTP API: the last value of a metric is its newest
+    # sample and a mean its avg_over_time, asked one query per metric or in a
+    # single batch query. Only the metrics of plan, a {(window, group):
+    # [metric]} dict, are fetched by Fetch, every metric by default
+    def __init__(
+        self, session, url, timeout, instrumentation, logger, plan=None, batch=False
+    ):
+        self.session = session
+        self.timeout = timeout
+        self.instrumentation = instrumentation
+        self.logger = logger
+        self.plan = plan
+        # fetch last values and means in one query instead of one per metric
+        self.batch = batch
+        self.query_url = "{}/api/v1/query".format(url)
+        self.query_urls = {}
+        self.metric_group = {
+            item: group for group, entry in METRICS.items() for item in entry
+        }
+
+    def QueryUrl(self, query):
+        # encode the query once, Run asks for the same queries every cycle
+        url = self.query_urls.get(query)
+        if url is None:
+            url = "{}?{}".format(self.query_url, urlencode({"query": query}))
+            self.query_urls[query] = url
+        return url
+
+    def MeanQuery(self, item, seconds):
+        return "avg_over_time({}[{}])".format(item, Duration(seconds))
+
+    def Query(self, query):
+        # [time, value] of the first serie answered
+        return self.QueryVector(query)[0]["value"]
+
+    def QueryVector(self, query, label=None):
+        try:
+            with self.instrumentation.Timer(
+                "ems_query_duration_seconds", query=label or query
+            ):
+                response = self.session.get(self.QueryUrl(query), timeout=self.timeout)
+            if response.status_code == 200:
+                # Parse the JSON response
+                result = response.json()
+                return result["data"]["result"]
+            else:
+                self.logger.Log(
+                    syslog.LOG_ERR,
+                    "Failed to fetch data. HTTP Status code: {}".format(
+                        response.status_code
+                    ),
+                    key="fetch",
+                )
+                raise Exception(
+                    "VictoriaMetrics returned HTTP {}".format(response.status_code)
+                )
+        except Exception as e:
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while querying data {}".format(e),
+                key="querying data",
+            )
+            raise e
+
+    def Items(self, window, group):
+        # metrics of group fetched for window
+        if self.plan is None:
+            return METRICS[group]
+        return self.plan.get((window, group), [])
+
+    def Values(self, items, seconds=None, result=None):
+        # newest values of items, or their means over seconds, one query
+        # each, set in result: a new dict or the snapshot given
+        if result is None:
+            result = {}
+        for item in items:
+            if seconds is None:
+                value = self.Query(item)
+            else:
+                value = self.Query(self.MeanQuery(item, seconds))
+            result[item] = float(value[1])
+        result["time"] = value[0]
+        return result
+
+    def Last(self, groups):
+        return {
+            group: self.Values(self.Items("last", group))
+            for group in groups
+            if self.Items("last", group)
+        }
+
+    def Mean(self, groups, seconds):
+        return {group: self.Values(METRICS[group], seconds) for group in groups}
+
+    def BatchQuery(self, groups, windows):
+        # select the planned metrics of the groups at once, then tag each
+        # instant vector with the window it belongs to so a single query
+        # returns the last values and both means
+        queries = []
+        for window, seconds in windows.items():
+            items = [item for group in groups for item in self.Items(window, group)]
+            if not items:
+                continue
+            selector = ItemSelector(items)
+            if window == "last":
+                queries.append(
+                    'label_replace({}, "{}", "last", "", "")'.format(
+                        selector, WINDOW_LABEL
+                    )
+                )
+                continue
+            queries.append(
+                'label_replace(avg_over_time({}[{}]) keep_metric_names, "{}", "{}", "", "")'.format(
+                    selector, Duration(seconds), WINDOW_LABEL, window
+                )
+            )
+        return " or ".join(queries)
+
+    def FetchBatch(self, groups, windows, staging):
+        # every window in a single query, demultiplexed by its window label.
+        # The cleared snapshots hold NaN until a serie sets a metric
+        keys = [
+            (window, group)
+            for window in windows
+            for group in groups
+            if self.Items(window, group)
+        ]
+        for key in keys:
+            staging[key].Clear()
+        for serie in self.QueryVector(
+            self.BatchQuery(groups, windows), "batch {}".format("+".join(windows))
+        ):
+            window = serie["metric"].get(WINDOW_LABEL)
+            item = serie["metric"].get("__name__")
+            group = self.metric_group.get(item)
+            if (
+                group is None
+                or window not in windows
+                or item not in self.Items(window, group)
+            ):
+                continue
+            snapshot = staging[window, group]
+            # keep the first serie like Query does
+            if not math.isnan(snapshot[item]):
+                continue
+            snapshot[item] = float(serie["value"][1])
+            snapshot["time"] = serie["value"][0]
+
+        for window, group in keys:
+            snapshot = staging[window, group]
+            missing = [
+                item for item in self.Items(window, group) if math.isnan(snapshot[item])
+            ]
+            if missing:
+                raise Exception(
+                    "missing {} {} values in batch result".format(
+                        window, ", ".join(missing)
+                    )
+                )
+        return keys
+
+    def Fetch(self, groups, windows, staging):
+        if self.batch:
+            return self.FetchBatch(groups, windows, staging)
+        keys = []
+        for window, seconds in windows.items():
+            for group in groups:
+                items = self.Items(window, group)
+                if items:
+                    snapshot = staging[window, group]
+                    snapshot.Clear()
+                    self.Values(items, seconds, snapshot)
+                    keys.append((window, group))
+        return keys
+
+
+class InfluxDB(Backend):
+    # InfluxDB 1.x fed by the inverter exporter: one measurement per group,
+    # its fields named after the metrics without the group prefix
+    def __init__(self, host, port, user, password, database, timeout=5.0):
+        if influxdb is None:
+            raise ImportError("the influx backend needs the influxdb package")
+        self.client = influxdb.InfluxDBClient(
+            host, port, user, password, database, timeout=timeout
+        )
+        # multi-statement query of each windows asked by Fetch
+        self.queries = {}
+
+    def Field(self, group, item):
+        return item[len(group) + 1 :]
+
+    def LastQuery(self, group):
+        fields = [self.Field(group, item) for item in METRICS[group]]
+        # the other fields come from the point selected by LAST
+        return "SELECT LAST({}), {} FROM {}".format(
+            fields[0], ", ".join(fields[1:]), group
+        )
+
+    def MeanQuery(self, group, seconds):
+        return "SELECT MEAN(*) FROM {} WHERE time > now() - {}".format(
+            group, Duration(seconds)
+        )
+
+    def Values(self, group, result, prefix, values=None):
+        # METRICS mapping of the first point of a query result, set in values:
+        # a new dict or the snapshot given
+        point = next(result.get_points(), None)
+        if point is None:
+            raise Exception("no {} data".format(group))
+        if values is None:
+            values = {}
+        values["time"] = float(point["time"])
+        for index, item in enumerate(METRICS[group]):
+            field = self.Field(group, item)
+            if prefix is None:
+                # LAST names its column after itself
+                key = "last" if index == 0 else field
+            else:
+                key = prefix + field
+            if point.get(key) is None:
+                raise Exception("missing {} in {} data".format(field, group))
+            values[item] = float(point[key])
+        return values
+
+    def Query(self, query):
+        # timestamps in seconds, like the other backends
+        return self.client.query(query, epoch="s")
+
+    def Last(self, groups):
+        return {
+            group: self.Values(group, self.Query(self.LastQuery(group)), None)
+            for group in groups
+        }
+
+    def Mean(self, groups, seconds):
+        return {
+            group: self.Values(
+                group, self.Query(self.MeanQuery(group, seconds)), "mean_"
+            )
+            for group in groups
+        }
+
+    def Statements(self, groups, windows):
+        # (window, group, column prefix) of each statement and the query
+        # sending all of them, built once per windows
+        key = (tuple(groups), tuple(windows.items()))
+        statements = self.queries.get(key)
+        if statements is None:
+            targets = []
+            queries = []
+            for window, seconds in windows.items():
+                for group in groups:
+                    if window == "last":
+                        targets.append((window, group, None))
+                        queries.append(self.LastQuery(group))
+                    else:
+                        targets.append((window, group, "mean_"))
+                        queries.append(self.MeanQuery(group, seconds))
+            statements = self.queries[key] = (targets, ";".join(queries))
+        return statements
+
+    def Fetch(self, groups, windows, staging):
+        # every statement in a single request, InfluxDB answers one result
+        # set per statement in order
+        targets, query = self.Statements(groups, windows)
+        results = self.Query(query)
+        if not isinstance(results, list):
+            results = [results]
+        if len(results) != len(targets):
+            raise Exception(
+                "{} result sets for {} statements".format(len(results), len(targets))
+            )
+        keys = []
+        for (window, group, prefix), result in zip(targets, results):
+            snapshot = staging[window, group]
+            snapshot.Clear()
+            self.Values(group, result, prefix, snapshot)
+            keys.append((window, group))
+        return keys
+
+    def close(self):
+        self.client.close()
 
 
 class EMS:
     # init class loading config file value
-    def __init__(self, config_path):
+    def __init__(self, config_path, clock=None, backend=None):
+        # every time of the control core comes from clock
+        self.clock = clock or Clock()
         try:
-            with open(config_path, "r") as jsonfile:
-                config = json.load(jsonfile)
-                # store the wall config in this var to update the config file
-                self.conf = config
+            # store the wall config in this var to update the config file,
+            # the EMS itself only reads the typed config
+            self.conf, self.config = LoadConfig(config_path)
         except Exception as e:
             syslog.syslog(syslog.LOG_ERR, "Failed to load configuration: {}".format(e))
             raise e
@@ -27,278 +1900,411 @@ class EMS:
         signal.signal(signal.SIGTERM, self.graceful_exit)  # for systemd stops
         signal.signal(signal.SIGINT, self.graceful_exit)  # for Ctrl+C
 
-        self.conf["mean"]["short"] = int(self.conf["mean"]["short"])
-        self.conf["mean"]["long"] = int(self.conf["mean"]["long"])
-        if "hydro" in self.conf:
-            self.conf["hydro"]["off_condition"]["long"]["battery_voltage_limit"] = (
-                float(
-                    self.conf["hydro"]["off_condition"]["long"]["battery_voltage_limit"]
-                )
-            )
-            self.conf["hydro"]["on_condition"]["battery_voltage"] = float(
-                self.conf["hydro"]["on_condition"]["battery_voltage"]
-            )
+        # timings and counters of the hot path, served on a local /metrics
+        # endpoint and/or periodically pushed to VictoriaMetrics
+        self.instrumentation = Instrumentation()
 
-            RELAY_HYDRO_PIN = int(self.conf["hydro"]["relay_pin"])
-            self.hydro = {
-                "enable": True,
-                "timer": datetime.now()
-                - timedelta(minutes=int(self.conf["hydro"]["state_timer"])),
-                "state_timer": int(self.conf["hydro"]["state_timer"]),
-                "off_condition": self.conf["hydro"]["off_condition"],
-                "on_condition": self.conf["hydro"]["on_condition"],
-                "on": False,
-            }
-            self.relay_hydro = gpiozero.OutputDevice(
-                RELAY_HYDRO_PIN, active_high=False, initial_value=False
+        config = self.config
+        # log writes are queued and done by a background thread
+        self.logger = Logger(
+            self.instrumentation,
+            config.log_size,
+            config.log_interval,
+            config.log_console,
+            config.log_syslog,
+            self.clock.Monotonic,
+        )
+        # runtime and timers of the loads, kept across restarts
+        self.journal = None
+        if config.journal is not None:
+            self.journal = Journal(*config.journal)
+        # loads in config order, relays are only written on change and read
+        # back every verify_period seconds
+        self.loads = {
+            conf.name: Load(
+                conf,
+                self.instrumentation,
+                config.verify_period,
+                self.clock,
+                self.logger,
+                self.journal,
             )
+            for conf in config.loads
+        }
+        # allocation order, highest priority first
+        self.allocation = sorted(self.loads.values(), key=lambda load: -load.priority)
+        self.allocation_reserve = config.reserve
+        self.budgeted = any(load.power > 0 for load in self.allocation)
+        # the heater and hydro states stay reachable as before
+        if "hydro" in self.loads:
+            self.hydro = self.loads["hydro"].state
+            self.relay_hydro = self.loads["hydro"].relay
         else:
             self.hydro = {"enable": False}
+        if "heater" in self.loads:
+            self.heater = self.loads["heater"].state
+            self.relay_heater = self.loads["heater"].relay
+        else:
+            self.heater = {"enable": False}
 
-        if "heater" in self.conf:
-            self.conf["heater"]["off_condition"]["timeout"] = int(
-                self.conf["heater"]["off_condition"]["timeout"]
-            )
-            self.conf["heater"]["off_condition"]["max_daily_run"] = float(
-                self.conf["heater"]["off_condition"]["max_daily_run"]
-            )
-            self.conf["heater"]["off_condition"]["short"]["battery_voltage_limit"] = (
-                float(
-                    self.conf["heater"]["off_condition"]["short"][
-                        "battery_voltage_limit"
-                    ]
-                )
-            )
-            self.conf["heater"]["off_condition"]["short"]["load_limit"] = float(
-                self.conf["heater"]["off_condition"]["short"]["load_limit"]
-            )
-            self.conf["heater"]["off_condition"]["long"]["battery_voltage_limit"] = (
-                float(
-                    self.conf["heater"]["off_condition"]["long"][
-                        "battery_voltage_limit"
-                    ]
-                )
+        # measurements of every group and window, updated in place
+        for group in METRICS:
+            for window in WINDOWS:
+                setattr(self, MeasurementsName(window, group), Snapshot(group))
+        # batch results are parsed in these before being published
+        self.staging = {
+            (window, group): Snapshot(group) for window in WINDOWS for group in METRICS
+        }
+
+        self.victoriametrics_url = config.url
+        # measurements are read through a Backend, the VictoriaMetrics one
+        # also serves the acquisition modes below
+        victoria = backend is None and config.backend == "victoria"
+        self.metric_group = {
+            item: group for group, entry in METRICS.items() for item in entry
+        }
+
+        # compute short and long means from the last values instead of
+        # asking VictoriaMetrics to rescan both windows every cycle
+        self.local_mean = config.local_mean
+        # backfill and incremental read the VictoriaMetrics export endpoint
+        self.backfill = config.backfill and victoria
+        # only fetch the samples stored since the previous cycle, this needs
+        # the means to be computed locally
+        self.incremental = config.incremental and victoria
+        # receive samples pushed by the inverter exporter instead of polling,
+        # means are then computed locally too
+        self.push = config.push is not None
+        if self.incremental or self.push:
+            self.local_mean = True
+        # pushed samples and the safety tier are handled from other threads
+        self.lock = threading.RLock()
+        # check the trip conditions of running loads at a faster rate than
+        # the whole cycle, pushed samples already trigger every check
+        self.period = config.period
+        self.scheduler = CycleScheduler(
+            self.period, self.clock.Monotonic, self.clock.Sleep
+        )
+        self.safety_period = None
+        self.safety_thread = None
+        if config.safety_period is not None and not self.push:
+            self.safety_period = config.safety_period
+            self.safety_scheduler = CycleScheduler(
+                self.safety_period, self.clock.Monotonic, self.clock.Sleep
             )
-            self.conf["heater"]["off_condition"]["long"]["load_limit"] = float(
-                self.conf["heater"]["off_condition"]["long"]["load_limit"]
-            )
-            self.conf["heater"]["off_condition"]["long"]["input_power"] = float(
-                self.conf["heater"]["off_condition"]["long"]["input_power"]
-            )
-            self.conf["heater"]["on_condition"]["battery_voltage"] = float(
-                self.conf["heater"]["on_condition"]["battery_voltage"]
-            )
-            self.conf["heater"]["on_condition"]["input_power"] = int(
-                self.conf["heater"]["on_condition"]["input_power"]
-            )
-            # Triggered by the output pin going high: active_high=True
-            # Initially off: initial_value=False
-            RELAY_HEATER_PIN = int(self.conf["heater"]["relay_pin"])
-            self.heater = {
-                "heating_time_counter": float(0),
-                "heating_time_reset": datetime.now(),
-                "state_timer": int(self.conf["heater"]["state_timer"]),
-                "off_condition": self.conf["heater"]["off_condition"],
-                "on_condition": self.conf["heater"]["on_condition"],
-                "on": False,
-                "timer": datetime.now()
-                - timedelta(minutes=int(self.conf["heater"]["state_timer"])),
+        self.last_samples = {}
+        read = {item for _, item in Dependencies(config)}
+        # groups acquired for the local means, the grid one only when a rule
+        # reads it
+        self.groups = ACQUIRED_GROUPS + [
+            group
+            for group in METRICS
+            if group not in ACQUIRED_GROUPS
+            and any(item in read for item in METRICS[group])
+        ]
+        self.dated = DatingMetrics(config)
+        if self.local_mean:
+            self.fetched_windows = ["last"]
+            self.windows = {
+                item: {
+                    window: RollingMean(config.mean[window])
+                    for window in ["short", "long"]
+                }
+                for group in self.groups
+                for item in METRICS[group]
             }
+            # the rolling means need the last values of every metric
+            self.plan = {
+                (window, group): METRICS[group]
+                for window in WINDOWS
+                for group in self.groups
+            }
+        else:
+            self.fetched_windows = ["last", "short", "long"]
+            # only the (window, metric) the loads read are queried
+            self.plan = FetchPlan(config)
+        # read the means from the series recorded by vmalert, see
+        # RecordingRules
+        self.recorded = config.recorded and victoria and not self.local_mean
 
-            self.run_timer = datetime.now().timestamp()
-            self.relay_heater = gpiozero.OutputDevice(
-                RELAY_HEATER_PIN, active_high=False, initial_value=False
+        # fetch every group in parallel, the cycle then lasts as long as the
+        # slowest query instead of the sum of all of them
+        self.concurrent = config.concurrent and victoria and not config.batch
+        self.deadline = config.deadline
+        workers = 3 * len(ACQUIRED_GROUPS)
+        if self.concurrent:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="ems-acquisition"
             )
-        else:
-            self.heater = {"enable": False}
 
-        self.victoriametrics_url = "{}:{}".format(
-            self.conf["victoria"]["url"], self.conf["victoria"]["port"]
+        # keep connections to VictoriaMetrics alive between cycles and never
+        # wait forever on it while a relay may be energised
+        self.timeout = config.timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max(
+                config.pool_size,
+                workers if self.concurrent else 1,
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.export_url = "{}/api/v1/export".format(self.victoriametrics_url)
+
+        self.backend = backend
+        self.victoria = None
+        if victoria:
+            self.backend = self.victoria = VictoriaMetrics(
+                self.session,
+                self.victoriametrics_url,
+                self.timeout,
+                self.instrumentation,
+                self.logger,
+                self.plan,
+                config.batch,
+            )
+        elif self.backend is None:
+            self.backend = InfluxDB(*config.influx)
+        if self.victoria is None:
+            return
+        for (window, group), items in self.plan.items():
+            for item in items:
+                if window == "last":
+                    self.victoria.QueryUrl(item)
+                else:
+                    self.victoria.QueryUrl(self.MeanQuery(item, config.mean[window]))
+        self.victoria.QueryUrl(
+            self.victoria.BatchQuery(METRICS, self.Windows(self.fetched_windows))
         )
 
     def graceful_exit(self, signum, frame):
         # debug print(f"Signal received at {frame.f_code.co_filename}, line {frame.f_lineno}")
-        syslog.syslog(
+        self.logger.Log(
             syslog.LOG_INFO,
-            "Received signal {}, disable hydro and Heater".format(signum),
+            "Received signal {}, disable {}".format(signum, ", ".join(self.loads)),
         )
-        if self.hydro["enable"] == True:
-            self.StopHydro()
-        if self.heater["enable"] == True:
-            self.StopHeater()
+        for load in self.loads.values():
+            load.Stop()
+        if self.journal is not None:
+            self.journal.close()
+        self.logger.Flush()
         exit(0)
 
-    def QueryVictoriaMetrics(self, params):
-        url = "{}/api/v1/query".format(self.victoriametrics_url)
+    def MeanQuery(self, item, range):
+        return self.victoria.MeanQuery(item, range)
+
+    def QueryVictoriaMetrics(self, query):
+        return self.victoria.Query(query)
+
+    def QueryVictoriaMetricsVector(self, query, label=None):
+        return self.victoria.QueryVector(query, label)
+
+    def MetricSelector(self, groups):
+        return ItemSelector(item for group in groups for item in METRICS[group])
+
+    def Planned(self, window, groups):
+        # metrics of the groups fetched for window
+        return [item for group in groups for item in self.plan.get((window, group), [])]
+
+    def Windows(self, windows):
+        # {window: seconds} of windows, None for the last values
+        return {
+            window: None if window == "last" else self.config.mean[window]
+            for window in windows
+        }
+
+    def RecordedQuery(self, windows):
+        # newest sample of the recorded means of windows, None when none of
+        # them is recorded. Samples older than recorded_max_age are stale
+        names = sorted(
+            {
+                RecordedName(item, self.config.mean[window])
+                for window in windows
+                for item in self.Planned(window, METRICS)
+            }
+        )
+        if not names:
+            return None
+        return 'last_over_time({{__name__=~"{}"}}[{}s]) keep_metric_names'.format(
+            "|".join(names), int(self.config.recorded_max_age)
+        )
+
+    def GetRecordedMeans(self, windows):
+        # planned means of windows from the recorded series, the missing or
+        # stale ones are computed live
+        planned = [
+            (window, group)
+            for window in windows
+            for group in METRICS
+            if (window, group) in self.plan
+        ]
         try:
-            response = requests.get(url, params=params)
-            if response.status_code == 200:
-                # Parse the JSON response
-                result = response.json()
-                return result["data"]["result"][0]["value"]
-            else:
-                syslog.syslog(
-                    syslog.LOG_ERR,
-                    "Failed to fetch data. HTTP Status code: {}".format(
-                        response.status_code
-                    ),
-                )
+            found = {}
+            query = self.RecordedQuery(windows)
+            if query is not None:
+                for serie in self.QueryVictoriaMetricsVector(query, "recorded"):
+                    found.setdefault(serie["metric"].get("__name__"), serie["value"])
+            for window, group in planned:
+                seconds = self.config.mean[window]
+                result = self.staging[window, group]
+                for item in self.plan[window, group]:
+                    name = RecordedName(item, seconds)
+                    value = found.get(name)
+                    if value is None:
+                        self.instrumentation.Inc(
+                            "ems_recorded_fallbacks_total", metric=item, window=window
+                        )
+                        self.logger.Log(
+                            syslog.LOG_WARNING,
+                            "ems: no recent {}, computing it live".format(name),
+                            key=name,
+                        )
+                        value = self.QueryVictoriaMetrics(self.MeanQuery(item, seconds))
+                    result[item] = float(value[1])
+                result["time"] = value[0]
         except Exception as e:
-            syslog.syslog(syslog.LOG_ERR, "Error while querying data {}".format(e))
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting recorded means {}".format(e),
+                key="getting recorded means",
+            )
             raise e
 
-    def GetLastBatteryData(self):
+        return self.Publish(planned)
+
+    def GetLastBatteryData(self, items=None):
         try:
             result = {}
-            entry = [
-                "battery_DC_V",
-                "battery_charging_current",
-                "battery_discharge_current",
-            ]
+            entry = items or METRICS["battery"]
             for item in entry:
-                tmp = self.QueryVictoriaMetrics({"query": item})
+                tmp = self.QueryVictoriaMetrics(item)
                 result[item] = float(tmp[1])
             result["time"] = tmp[0]
-            self.last_battery_measurements = result
         except Exception as e:
-            syslog.syslog(
-                syslog.LOG_ERR, "Error while getting Battery data {}".format(e)
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting Battery data {}".format(e),
+                key="getting Battery data",
             )
             raise e
-        return True
+        return result
 
-    def GetMeanBatteryData(self, range):
+    def GetMeanBatteryData(self, range, items=None):
         try:
             result = {}
-            entry = [
-                "battery_DC_V",
-                "battery_charging_current",
-                "battery_discharge_current",
-            ]
+            entry = items or METRICS["battery"]
             for item in entry:
-                tmp = self.QueryVictoriaMetrics(
-                    {"query": "avg_over_time({}[{}m])".format(item, range)}
-                )
+                tmp = self.QueryVictoriaMetrics(self.MeanQuery(item, range))
                 result[item] = float(tmp[1])
             result["time"] = tmp[0]
         except Exception as e:
-            syslog.syslog(
-                syslog.LOG_ERR, "Error while getting Battery data {}".format(e)
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting Battery data {}".format(e),
+                key="getting Battery data",
             )
             raise e
         return result
 
-    def GetLastPVData(self):
+    def GetLastPVData(self, items=None):
         try:
             result = {}
-            entry = [
-                "pv_DC_V",
-                "pv_A",
-                "pv_W",
-            ]
+            entry = items or METRICS["pv"]
             for item in entry:
-                tmp = self.QueryVictoriaMetrics({"query": item})
+                tmp = self.QueryVictoriaMetrics(item)
                 result[item] = float(tmp[1])
             result["time"] = tmp[0]
-            self.last_pv_measurements = result
         except Exception as e:
-            syslog.syslog(syslog.LOG_ERR, "Error while getting pv data {}".format(e))
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting pv data {}".format(e),
+                key="getting pv data",
+            )
             raise e
-        return True
+        return result
 
-    def GetMeanPVData(self, range):
+    def GetMeanPVData(self, range, items=None):
         try:
             result = {}
-            entry = [
-                "pv_DC_V",
-                "pv_A",
-                "pv_W",
-            ]
+            entry = items or METRICS["pv"]
             for item in entry:
-                tmp = self.QueryVictoriaMetrics(
-                    {"query": "avg_over_time({}[{}m])".format(item, range)}
-                )
+                tmp = self.QueryVictoriaMetrics(self.MeanQuery(item, range))
                 result[item] = float(tmp[1])
             result["time"] = tmp[0]
         except Exception as e:
-            syslog.syslog(
-                syslog.LOG_ERR, "Error while getting mean PV data {}".format(e)
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting mean PV data {}".format(e),
+                key="getting mean PV data",
             )
             raise e
         return result
 
-    def GetLastOutData(self):
+    def GetLastOutData(self, items=None):
         try:
             result = {}
-            entry = [
-                "out_AC_V",
-                "out_Hz",
-                "out_load_percent",
-                "out_load_va",
-                "out_load_watt",
-            ]
+            entry = items or METRICS["out"]
             for item in entry:
-                tmp = self.QueryVictoriaMetrics({"query": item})
+                tmp = self.QueryVictoriaMetrics(item)
                 result[item] = float(tmp[1])
             result["time"] = tmp[0]
-            self.last_out_measurements = result
         except Exception as e:
-            syslog.syslog(
-                syslog.LOG_ERR, "Error while getting smart grid data {}".format(e)
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting smart grid data {}".format(e),
+                key="getting smart grid data",
             )
             raise e
-        return True
+        return result
 
-    def GetMeanOutData(self, range):
+    def GetMeanOutData(self, range, items=None):
         try:
             result = {}
-            entry = [
-                "out_AC_V",
-                "out_Hz",
-                "out_load_percent",
-                "out_load_va",
-                "out_load_watt",
-            ]
+            entry = items or METRICS["out"]
             for item in entry:
-                tmp = self.QueryVictoriaMetrics(
-                    {"query": "avg_over_time({}[{}m])".format(item, range)}
-                )
+                tmp = self.QueryVictoriaMetrics(self.MeanQuery(item, range))
                 result[item] = float(tmp[1])
             result["time"] = tmp[0]
         except Exception as e:
-            syslog.syslog(
-                syslog.LOG_ERR, "Error while getting mean smart grid data {}".format(e)
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting mean smart grid data {}".format(e),
+                key="getting mean smart grid data",
             )
             raise e
         return result
 
-    def GetLastGridData(self):
+    def GetLastGridData(self, items=None):
         try:
             result = {}
-            entry = ["grid_AC_V", "grid_Hz"]
+            entry = items or METRICS["grid"]
             for item in entry:
-                tmp = self.QueryVictoriaMetrics({"query": item})
+                tmp = self.QueryVictoriaMetrics(item)
                 result[item] = float(tmp[1])
             result["time"] = tmp[0]
-            self.last_grid_measurements = result
         except Exception as e:
-            syslog.syslog(syslog.LOG_ERR, "Error while getting grid data {}".format(e))
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting grid data {}".format(e),
+                key="getting grid data",
+            )
             raise e
-        return True
+        return result
 
-    def GetMeanGridData(self, range):
+    def GetMeanGridData(self, range, items=None):
         try:
             result = {}
-            entry = ["grid_AC_V", "grid_Hz"]
+            entry = items or METRICS["grid"]
             for item in entry:
-                tmp = self.QueryVictoriaMetrics(
-                    {"query": "avg_over_time({}[{}m])".format(item, range)}
-                )
+                tmp = self.QueryVictoriaMetrics(self.MeanQuery(item, range))
                 result[item] = float(tmp[1])
             result["time"] = tmp[0]
         except Exception as e:
-            syslog.syslog(
-                syslog.LOG_ERR, "Error while getting mean grid data {}".format(e)
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting mean grid data {}".format(e),
+                key="getting mean grid data",
             )
             raise e
         return result
@@ -315,285 +2321,599 @@ class EMS:
         #   load mean (on 10min) higher than X (2000W)
         #   battery voltage mean (on 10min) lower than X (23?) volts
 
+    def CheckHeaterSafety(self, now=None):
+        return self.loads["heater"].CheckSafety(self, now)
+
     def CheckHeater(self):
-        now = datetime.now()
-        deadline = now - timedelta(seconds=int(self.heater["off_condition"]["timeout"]))
+        self.loads["heater"].Check(self)
 
-        date = [
-            datetime.fromtimestamp(self.last_battery_measurements["time"]),
-            datetime.fromtimestamp(self.last_pv_measurements["time"]),
-            datetime.fromtimestamp(self.last_out_measurements["time"]),
-        ]
+    def CheckHydroSafety(self, now=None):
+        return self.loads["hydro"].CheckSafety(self, now)
 
-        # reset heating timer counter
-        if self.heater["heating_time_reset"].day != datetime.today().day:
-            syslog.syslog(
-                syslog.LOG_INFO,
-                "ems: reset max daily heating run counter. Running time: {}".format(
-                    self.heater["heating_time_counter"]
-                ),
-            )
-            self.heater["heating_time_counter"] = float(0)
-            self.heater["heating_time_reset"] = datetime.now()
-
-        if self.heater["on"]:
-            # if last grid value to old power off
-            if date[0] < deadline or date[1] < deadline or date[2] < deadline:
-                print("Last value too old !!!")
-                print("Disable heater !!!")
-                self.StopHeater()
-                self.heater["timer"] = datetime.now()
-                syslog.syslog(
-                    syslog.LOG_WARNING,
-                    "ems: deadline condition match, turning off heater. No data incoming since {}".format(
-                        date
-                    ),
-                )
-                return
+    def CheckHydro(self):
+        self.loads["hydro"].Check(self)
 
-            # if run more than X hours per stop
-            if (
-                self.heater["off_condition"]["max_daily_run"] * 3600
-                < self.heater["heating_time_counter"]
-            ):
-                self.StopHeater()
-                self.heater["timer"] = datetime.now()
-                print("Max daily run reached, turn off heater")
-                syslog.syslog(
-                    syslog.LOG_INFO,
-                    "ems: Max daily run reached, turning off heater. Running time: {}".format(
-                        self.heater["heating_time_counter"]
-                    ),
-                )
-                return
+    def StartHydro(self):
+        self.loads["hydro"].Start()
 
-            # if short condition match, trigger power off
-            if (
-                self.heater["off_condition"]["short"]["load_limit"]
-                < self.short_mean_out_measurements["out_load_watt"]
-                or self.heater["off_condition"]["short"]["battery_voltage_limit"]
-                > self.short_mean_battery_measurements["battery_DC_V"]
-            ):
-                self.StopHeater()
-                self.heater["timer"] = datetime.now()
-                print("short limit, turn off heater")
-                syslog.syslog(
-                    syslog.LOG_INFO,
-                    "ems: short condition match, turning off heater. Battery {}, Load: {}".format(
-                        self.short_mean_battery_measurements["battery_DC_V"],
-                        self.short_mean_out_measurements["out_load_watt"],
-                    ),
-                )
-                return
-            # if long condition match, trigger power off
-            if (
-                self.heater["off_condition"]["long"]["load_limit"]
-                < self.long_mean_out_measurements["out_load_watt"]
-                or self.heater["off_condition"]["long"]["battery_voltage_limit"]
-                > self.long_mean_battery_measurements["battery_DC_V"]
-                or self.heater["off_condition"]["long"]["input_power"]
-                > self.long_mean_pv_measurements["pv_W"]
-            ):
-                self.StopHeater()
-                self.heater["timer"] = datetime.now()
-                print("long limit, turn off heater")
-                syslog.syslog(
-                    syslog.LOG_INFO,
-                    "ems: long condition match, turning off heater. Battery {}, Load: {}, Input_power: {}".format(
-                        self.long_mean_battery_measurements["battery_DC_V"],
-                        self.long_mean_out_measurements["out_load_watt"],
-                        self.long_mean_pv_measurements["pv_W"],
-                    ),
-                )
-                return
+    def StopHydro(self):
+        self.loads["hydro"].Stop()
 
-        deadline = now - timedelta(minutes=self.heater["state_timer"])
+    def StartHeater(self):
+        self.loads["heater"].Start()
 
-        # if off more than X minutes we try to start heater and daily run not reached
-        if (
-            not self.heater["on"]
-            and self.heater["timer"] < deadline
-            and self.heater["off_condition"]["max_daily_run"] * 3600
-            > self.heater["heating_time_counter"]
-        ):
-            # if last input higher than 26 V and 400w, we start heater
-            if (
-                self.last_battery_measurements["battery_DC_V"]
-                > self.heater["on_condition"]["battery_voltage"]
-                and self.last_pv_measurements["pv_W"]
-                > self.heater["on_condition"]["input_power"]
-                and self.last_out_measurements["out_load_watt"]
-                < self.heater["on_condition"]["output_power_limit"]
+    def StopHeater(self):
+        self.loads["heater"].Stop()
+
+    @property
+    def run_timer(self):
+        return self.loads["heater"].run_timer
+
+    @run_timer.setter
+    def run_timer(self, value):
+        self.loads["heater"].run_timer = value
+
+    def AcquisitionGroups(self, windows=None):
+        # getter and arguments of each acquisition group of the windows
+        if windows is None:
+            windows = self.fetched_windows
+        last = {
+            "battery": self.GetLastBatteryData,
+            "pv": self.GetLastPVData,
+            "out": self.GetLastOutData,
+            # only fetched when a rule reads it
+            "grid": self.GetLastGridData,
+        }
+        mean = {
+            "battery": self.GetMeanBatteryData,
+            "pv": self.GetMeanPVData,
+            "out": self.GetMeanOutData,
+            "grid": self.GetMeanGridData,
+        }
+        groups = {}
+        for window in windows:
+            for group in METRICS:
+                items = self.plan.get((window, group))
+                if items is None:
+                    continue
+                if window == "last":
+                    groups["last {}".format(group)] = (last[group], (items,))
+                else:
+                    groups["{} mean {}".format(window, group)] = (
+                        mean[group],
+                        (self.config.mean[window], items),
+                    )
+        return groups
+
+    def RunGroup(self, group, getter, args):
+        # fetch one acquisition group, timed and with its errors counted
+        try:
+            with self.instrumentation.Timer(
+                "ems_acquisition_duration_seconds", group=group
             ):
-                print("Start Heater !")
-                syslog.syslog(
-                    syslog.LOG_INFO,
-                    "ems: start condition match, turning on heater. Battery {}, Input power: {}, Load: {}".format(
-                        self.last_battery_measurements["battery_DC_V"],
-                        self.last_pv_measurements["pv_W"],
-                        self.last_out_measurements["out_load_watt"],
-                    ),
+                return getter(*args)
+        except Exception:
+            self.instrumentation.Inc("ems_acquisition_errors_total", group=group)
+            raise
+
+    def Publish(self, keys):
+        # copy the staged (window, group) in the measurements at once, the
+        # checks never see a half updated group
+        with self.lock:
+            for window, group in keys:
+                getattr(self, self.MeasurementsName(window, group)).CopyFrom(
+                    self.staging[window, group]
                 )
-                self.StartHeater()
-                self.heater["timer"] = datetime.now()
-                return
-        # If no condition was match, ensure current config is apply
-        if self.heater["on"]:
-            self.StartHeater()
-        else:
-            self.StopHeater()
+        return True
 
-    def CheckHydro(self):
-        now = datetime.now()
-        deadline = now - timedelta(seconds=int(self.hydro["off_condition"]["timeout"]))
+    def PublishGroups(self, results):
+        # publish {acquisition group: result} at once, after every group of
+        # the cycle succeeded
+        keys = []
+        for group, result in results.items():
+            if group.startswith("last "):
+                window, group = "last", group[len("last ") :]
+            else:
+                window, _, group = group.split(" ")
+            staging = self.staging[window, group]
+            staging.Clear()
+            staging.Set(result)
+            keys.append((window, group))
+        return self.Publish(keys)
 
-        date = [
-            datetime.fromtimestamp(self.last_battery_measurements["time"]),
-            datetime.fromtimestamp(self.last_pv_measurements["time"]),
-            datetime.fromtimestamp(self.last_out_measurements["time"]),
-        ]
-        if self.hydro["on"]:
-            # if last grid value to old power off
-            if date[0] < deadline or date[1] < deadline or date[2] < deadline:
-                print("Last value too old !!!")
-                print("Disable hydro !!!")
-                self.StopHydro()
-                self.hydro["timer"] = datetime.now()
-                syslog.syslog(
-                    syslog.LOG_WARNING,
-                    "ems: deadline condition match, turning off hydro. No data incoming since {}".format(
-                        date
-                    ),
+    def GetConcurrentData(self, windows=None):
+        futures = {
+            group: self.executor.submit(self.RunGroup, group, getter, args)
+            for group, (getter, args) in self.AcquisitionGroups(windows).items()
+        }
+        wait(futures.values(), timeout=self.deadline)
+
+        failures = {}
+        for group, future in futures.items():
+            if not future.done():
+                # let it finish in background, the getters only return their
+                # result so it is dropped
+                future.cancel()
+                failures[group] = "deadline of {}s exceeded".format(self.deadline)
+            elif future.exception() is not None:
+                failures[group] = future.exception()
+        if failures:
+            raise AcquisitionError(failures)
+
+        # only publish once every group succeeded
+        return self.PublishGroups(
+            {group: future.result() for group, future in futures.items()}
+        )
+
+    def MeasurementsName(self, window, group):
+        return MeasurementsName(window, group)
+
+    def DescribeRule(self, rule):
+        # values read by a compiled rule, for the logs
+        _, dependencies = rule
+        return ", ".join(
+            "{} {}: {}".format(
+                window,
+                item,
+                getattr(self, MeasurementsName(window, self.metric_group[item]))[item],
+            )
+            for window, item in dependencies
+        )
+
+    def AddSample(self, item, timestamp, value):
+        # feed one sample to the rolling windows of its metric
+        for rolling in self.windows[item].values():
+            rolling.Add(timestamp, value)
+        last = self.last_samples.get(item)
+        if last is None or last[0] < timestamp:
+            self.last_samples[item] = (timestamp, value)
+
+    def PublishMeans(self):
+        # publish the means in the same dicts as the ones fetched from
+        # VictoriaMetrics, dated like the last values they come from
+        for group in self.groups:
+            last = getattr(self, self.MeasurementsName("last", group))
+            for window in ["short", "long"]:
+                values = getattr(self, self.MeasurementsName(window, group)).values
+                values[0] = last["time"]
+                for index, item in enumerate(METRICS[group], 1):
+                    mean = self.windows[item][window].Mean()
+                    # empty window, no rule matches a NaN
+                    values[index] = math.nan if mean is None else mean
+        return True
+
+    def UpdateMeans(self):
+        # feed the fetched last values to the rolling windows
+        for group in self.groups:
+            last = getattr(self, self.MeasurementsName("last", group))
+            for item in METRICS[group]:
+                self.AddSample(item, last["time"], last[item])
+        return self.PublishMeans()
+
+    def ExportSamples(self, start):
+        # yield (metric, timestamp, value) for every sample stored since
+        # start. The export answer is one JSON object per line and per block
+        # of samples, it is decoded line by line to never hold the whole
+        # export in memory
+        params = {
+            "match[]": self.MetricSelector(self.groups),
+            "start": "{:.3f}".format(start),
+        }
+        series = {}
+        with self.instrumentation.Timer(
+            "ems_query_duration_seconds", query="export"
+        ), self.session.get(
+            self.export_url, params=params, timeout=self.timeout, stream=True
+        ) as response:
+            if response.status_code != 200:
+                raise Exception(
+                    "VictoriaMetrics returned HTTP {}".format(response.status_code)
                 )
-                return
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                block = json.loads(line)
+                item = block["metric"].get("__name__")
+                if item not in self.windows:
+                    continue
+                # keep the first serie like QueryVictoriaMetrics does
+                labels = series.setdefault(item, block["metric"])
+                if labels != block["metric"]:
+                    continue
+                for timestamp, value in zip(block["timestamps"], block["values"]):
+                    yield item, timestamp / 1000, float(value)
 
-            if (
-                self.hydro["off_condition"]["long"]["battery_voltage_limit"]
-                < self.long_mean_battery_measurements["battery_DC_V"]
+    def BackfillWindows(self):
+        # fill the rolling windows with the history of every metric in one
+        # export request, so a restart does not start from empty means
+        longest = max(self.config.mean.values())
+        count = 0
+        try:
+            for item, timestamp, value in self.ExportSamples(
+                self.clock.Time() - longest
             ):
-                self.StopHydro()
-                self.hydro["timer"] = datetime.now()
-                print("long limit, turn off hydro")
-                syslog.syslog(
-                    syslog.LOG_INFO,
-                    "ems: long condition match, turning off hydro. Battery {}, Load: {}, Input_power: {}".format(
-                        self.long_mean_battery_measurements["battery_DC_V"],
-                        self.long_mean_out_measurements["out_load_watt"],
-                        self.long_mean_pv_measurements["pv_W"],
+                self.AddSample(item, timestamp, value)
+                count += 1
+        except Exception as e:
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while backfilling mean windows {}".format(e),
+                key="backfilling mean windows",
+            )
+            raise e
+        self.logger.Log(
+            syslog.LOG_INFO,
+            "ems: backfilled mean windows with {} samples of {} metrics".format(
+                count, len(self.last_samples)
+            ),
+        )
+        return True
+
+    def Dated(self):
+        # whether every metric dating a group has a sample
+        return all(
+            item in self.last_samples for items in self.dated.values() for item in items
+        )
+
+    def PublishLast(self):
+        # publish the newest known sample of each metric in the last
+        # measurement dicts
+        for group in self.groups:
+            values = getattr(self, self.MeasurementsName("last", group)).values
+            if group not in self.dated:
+                # not watched by the data timeout, NaN until its first sample
+                times = [
+                    self.last_samples[item][0]
+                    for item in METRICS[group]
+                    if item in self.last_samples
+                ]
+                values[0] = min(times) if times else math.nan
+            else:
+                dated = self.dated[group]
+                missing = [item for item in dated if item not in self.last_samples]
+                if missing:
+                    raise Exception("no sample of {}".format(", ".join(missing)))
+                values[0] = min(self.last_samples[item][0] for item in dated)
+            for index, item in enumerate(METRICS[group], 1):
+                sample = self.last_samples.get(item)
+                values[index] = math.nan if sample is None else sample[1]
+        return True
+
+    def GetIncrementalData(self):
+        # only ask for the samples stored since the oldest last sample the
+        # rules read, the transfer then grows with the new data instead of
+        # the windows. Never further back than the longest window, samples
+        # older than it are evicted anyway
+        try:
+            start = self.clock.Time() - max(self.config.mean.values())
+            if self.Dated():
+                start = max(
+                    start,
+                    min(
+                        self.last_samples[item][0]
+                        for items in self.dated.values()
+                        for item in items
                     ),
                 )
-                return
-            # talvez parar segun la hora:
-            #
+            for item, timestamp, value in self.ExportSamples(start):
+                # AddSample drops the samples already known
+                self.AddSample(item, timestamp, value)
 
-        deadline = now - timedelta(minutes=self.hydro["state_timer"])
-        if not self.hydro["on"] and self.hydro["timer"] < deadline:
-            if (
-                self.last_battery_measurements["battery_DC_V"]
-                < self.hydro["on_condition"]["battery_voltage"]
-                or self.last_pv_measurements["pv_W"]
-                < self.hydro["on_condition"]["input_power"]
-                or self.last_out_measurements["out_load_watt"]
-                > self.hydro["on_condition"]["output_power_limit"]
+            with self.lock:
+                self.PublishLast()
+                return self.PublishMeans()
+        except Exception as e:
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting incremental data {}".format(e),
+                key="getting incremental data",
+            )
+            raise e
+
+    def GetBackendData(self, windows=None):
+        # every window of every group from the backend, published once all
+        # of them were read
+        if windows is None:
+            windows = self.fetched_windows
+        groups = [
+            group
+            for group in METRICS
+            if any((window, group) in self.plan for window in windows)
+        ]
+        # the tiers fetch different windows, each set is timed on its own
+        label = "backend {}".format("+".join(windows))
+        try:
+            with self.instrumentation.Timer(
+                "ems_acquisition_duration_seconds", group=label
             ):
+                keys = self.backend.Fetch(groups, self.Windows(windows), self.staging)
+        except Exception as e:
+            self.instrumentation.Inc("ems_acquisition_errors_total", group=label)
+            self.logger.Log(
+                syslog.LOG_ERR,
+                "Error while getting backend data {}".format(e),
+                key="getting backend data",
+            )
+            raise e
+        return self.Publish(keys)
 
-                print("Start Hydro !")
-                syslog.syslog(
-                    syslog.LOG_INFO,
-                    "ems: start condition match, starting hydro. Battery {}, Input power: {}, Load: {}".format(
-                        self.last_battery_measurements["battery_DC_V"],
-                        self.last_pv_measurements["pv_W"],
-                        self.last_out_measurements["out_load_watt"],
-                    ),
-                )
-                self.StartHydro()
-                self.hydro["timer"] = datetime.now()
-                return
+    def GetData(self, windows=None):
+        if self.recorded:
+            if windows is None:
+                windows = self.fetched_windows
+            means = [window for window in windows if window != "last"]
+            if means:
+                self.GetRecordedMeans(means)
+                windows = [window for window in windows if window == "last"]
+                if not windows:
+                    return True
+        if self.concurrent:
+            return self.GetConcurrentData(windows)
+        return self.GetBackendData(windows)
 
-        # If no condition was match, ensure current config is apply
-        if self.hydro["on"]:
-            self.StartHydro()
-        else:
-            self.StopHydro()
+    def AcquireData(self):
+        if self.incremental:
+            return self.GetIncrementalData()
+        self.GetData()
+        if self.local_mean:
+            with self.lock:
+                self.UpdateMeans()
+        return True
 
-    def StartHydro(self):
-        self.hydro["on"] = True
-        self.relay_hydro.on()
+    def AcquireSafety(self):
+        # last values and short means read by the trip conditions, for the
+        # safety tier
+        if self.incremental:
+            return self.GetIncrementalData()
+        if not self.local_mean:
+            return self.GetData(["last", "short"])
+        self.GetData(["last"])
+        with self.lock:
+            self.UpdateMeans()
+        return True
 
-    def StopHydro(self):
-        self.hydro["on"] = False
-        self.relay_hydro.off()
+    def AcquireMeans(self):
+        # long means only, for the slow tier, local means follow the last
+        # values
+        if self.local_mean:
+            return True
+        return self.GetData(["long"])
 
-    def StartHeater(self):
-        if not self.heater["on"]:
-            self.run_timer = datetime.now().timestamp()
-        self.heater["on"] = True
-        self.relay_heater.on()
+    def PowerBudget(self):
+        # PV surplus to share between the loads with a power rating: the
+        # short mean of the PV input minus the output load, without the loads
+        # already running. None when no load has a power rating
+        if not self.budgeted:
+            return None
+        budget = (
+            self.short_mean_pv_measurements["pv_W"]
+            - self.short_mean_out_measurements["out_load_watt"]
+            - self.allocation_reserve
+        )
+        for load in self.allocation:
+            if load.state["on"]:
+                budget += load.power
+        return budget
 
-    def StopHeater(self):
-        if self.heater["on"]:
-            self.heater["heating_time_counter"] += (
-                datetime.now().timestamp() - self.run_timer
-            )
-        self.heater["on"] = False
-        self.relay_heater.off()
+    def CheckLoads(self):
+        # a single pass in priority order, each load takes its power from
+        # the budget left by the previous ones
+        budget = self.PowerBudget()
+        for load in self.allocation:
+            with self.instrumentation.Timer(
+                "ems_check_duration_seconds", load=load.name, tier="cycle"
+            ):
+                budget = load.Check(self, budget)
 
-    def Run(self):
-        syslog.syslog(syslog.LOG_INFO, "ems started")
+    def CheckSafety(self):
+        # trip conditions of running loads, cheap enough for the fast tier
+        now = self.clock.Time()
+        for load in self.allocation:
+            if load.state["on"]:
+                with self.instrumentation.Timer(
+                    "ems_check_duration_seconds", load=load.name, tier="safety"
+                ):
+                    load.CheckSafety(self, now)
+
+    def RunSafety(self):
+        # fast tier: refresh the last values and short means and check the
+        # trip conditions, while Run refreshes the long means and handles the
+        # start conditions
         while True:
-            failCount = 0
-            now = datetime.now()
+            self.safety_scheduler.Wait()
             try:
-                self.GetLastBatteryData()
-                self.GetLastPVData()
-                self.GetLastOutData()
-                # useless for now self.GetLastGridData()
-
-                self.short_mean_battery_measurements = self.GetMeanBatteryData(
-                    self.conf["mean"]["short"]
-                )
-                self.short_mean_pv_measurements = self.GetMeanPVData(
-                    self.conf["mean"]["short"]
-                )
-                self.short_mean_out_measurements = self.GetMeanOutData(
-                    self.conf["mean"]["short"]
-                )
-                # useless for now self.short_mean_grid_measurements = self.GetMeanGridData(self.heater["off_condition"]["short"]["mean"])
-                self.long_mean_battery_measurements = self.GetMeanBatteryData(
-                    self.conf["mean"]["long"]
+                self.AcquireSafety()
+                with self.lock:
+                    self.CheckSafety()
+            except Exception as e:
+                self.logger.Log(
+                    syslog.LOG_WARNING,
+                    "Failed to run safety checks {}".format(e),
+                    key="run safety checks",
                 )
-                self.long_mean_pv_measurements = self.GetMeanPVData(
-                    self.conf["mean"]["long"]
+
+    def PushSamples(self, samples):
+        # update the measurements with pushed samples and react right away
+        with self.lock:
+            count = 0
+            for item, timestamp, value in samples:
+                if item in self.windows:
+                    self.AddSample(item, timestamp, value)
+                    count += 1
+            if count == 0 or not self.Dated():
+                return False
+            try:
+                self.PublishLast()
+                self.PublishMeans()
+                self.CheckLoads()
+            except Exception as e:
+                self.logger.Log(
+                    syslog.LOG_ERR,
+                    "Error while handling pushed data {}".format(e),
+                    key="handling pushed data",
                 )
-                self.long_mean_out_measurements = self.GetMeanOutData(
-                    self.conf["mean"]["long"]
+                return False
+        return True
+
+    def StartPushListener(self):
+        server = ThreadingHTTPServer(self.config.push, PushHandler)
+        server.daemon_threads = True
+        server.ems = self
+        thread = threading.Thread(
+            target=server.serve_forever, name="ems-push", daemon=True
+        )
+        thread.start()
+        self.logger.Log(
+            syslog.LOG_INFO,
+            "ems: listening for pushed data on {}:{}".format(*server.server_address),
+        )
+        return server
+
+    def ExportInstrumentation(self):
+        schedulers = [("cycle", self.scheduler)]
+        if self.safety_period is not None:
+            schedulers.append(("safety", self.safety_scheduler))
+        for tier, scheduler in schedulers:
+            stats = scheduler.Stats()
+            self.instrumentation.Count(
+                "ems_scheduler_cycles_total", stats["cycles"], tier=tier
+            )
+            self.instrumentation.Count(
+                "ems_scheduler_missed_total", stats["missed"], tier=tier
+            )
+            self.instrumentation.Set(
+                "ems_scheduler_jitter_max_seconds", stats["jitter_max"], tier=tier
+            )
+        return self.instrumentation.Export()
+
+    def PushInstrumentation(self):
+        # one batched write of every series to the import endpoint
+        response = self.session.post(
+            "{}/api/v1/import/prometheus".format(self.victoriametrics_url),
+            params={"extra_label": "job={}".format(self.config.metrics_job)},
+            data=self.ExportInstrumentation().encode(),
+            timeout=self.timeout,
+        )
+        if response.status_code not in (200, 204):
+            raise Exception(
+                "VictoriaMetrics returned HTTP {}".format(response.status_code)
+            )
+        return True
+
+    def RunInstrumentationPush(self):
+        scheduler = CycleScheduler(
+            self.config.metrics_push, self.clock.Monotonic, self.clock.Sleep
+        )
+        while True:
+            scheduler.Wait()
+            try:
+                self.PushInstrumentation()
+            except Exception as e:
+                self.logger.Log(
+                    syslog.LOG_WARNING,
+                    "Failed to push instrumentation {}".format(e),
+                    key="push instrumentation",
                 )
-                # useless for now self.long_mean_grid_measurements = self.GetMeanGridData(date[1], now_str)
-                failCount = 0
+
+    def StartMetricsListener(self):
+        server = ThreadingHTTPServer(self.config.metrics, MetricsHandler)
+        server.daemon_threads = True
+        server.ems = self
+        threading.Thread(
+            target=server.serve_forever, name="ems-metrics", daemon=True
+        ).start()
+        return server
+
+    def RefreshData(self):
+        # refresh the measurements used by the checks of one cycle
+        if self.push:
+            # pushed samples trigger the checks themselves, keep checking on
+            # each cycle so loads stop when the pushes do
+            with self.lock:
+                self.PublishLast()
+                return self.PublishMeans()
+        if self.safety_thread is not None:
+            # last values and short means are refreshed by the safety tier
+            return self.AcquireMeans()
+        return self.AcquireData()
+
+    def Run(self):
+        self.logger.Log(syslog.LOG_INFO, "ems started")
+        if self.local_mean and self.backfill:
+            try:
+                self.BackfillWindows()
             except Exception as e:
-                syslog.syslog(
-                    syslog.LOG_WARNING, "Failed to get influx data {}".format(e)
+                self.logger.Log(
+                    syslog.LOG_WARNING,
+                    "ems: starting with empty mean windows {}".format(e),
+                )
+        if self.push:
+            self.StartPushListener()
+        if self.config.metrics is not None:
+            self.StartMetricsListener()
+        if self.config.metrics_push is not None:
+            threading.Thread(
+                target=self.RunInstrumentationPush, name="ems-metrics", daemon=True
+            ).start()
+        while True:
+            missed = self.scheduler.Wait()
+            if missed:
+                self.logger.Log(
+                    syslog.LOG_WARNING,
+                    "ems: cycle overrun, skipped {} cycles ({} since start)".format(
+                        missed, self.scheduler.missed
+                    ),
+                    key="overrun",
                 )
-                failCount += 1
+            failCount = 0
+            with self.instrumentation.Timer("ems_cycle_duration_seconds"):
+                try:
+                    self.RefreshData()
+                    failCount = 0
+                except Exception as e:
+                    self.logger.Log(
+                        syslog.LOG_WARNING,
+                        "Failed to get influx data {}".format(e),
+                        key="cycle",
+                    )
+                    self.instrumentation.Inc("ems_cycle_failures_total")
+                    failCount += 1
 
+                if failCount == 0:
+                    with self.lock:
+                        self.CheckLoads()
             if failCount == 0:
-                if self.heater["enable"] == True:
-                    self.CheckHeater()
-                if self.hydro["enable"] == True:
-                    self.CheckHydro()
+                # start the safety tier once every measurement is known
+                if self.safety_period is not None and self.safety_thread is None:
+                    self.safety_thread = threading.Thread(
+                        target=self.RunSafety, name="ems-safety", daemon=True
+                    )
+                    self.safety_thread.start()
 
             elif failCount >= 10:
-                syslog.syslog(
+                self.logger.Log(
                     syslog.LOG_ERR,
                     "{} inverter polling failed in a raw, process".format(e),
                 )
-            time.sleep(2)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-c", "--conf", help="path to a config file")
+    parser.add_argument(
+        "--recording-rules",
+        action="store_true",
+        help="print the vmalert recording rules of the means the loads read",
+    )
+    parser.add_argument(
+        "--interval", help="evaluation interval of the recording rules, e.g. 30s"
+    )
     args = parser.parse_args()
 
+    if args.recording_rules:
+        _, config = LoadConfig(args.conf)
+        print(RecordingRules(config, args.interval), end="")
+        exit(0)
+
     ems = EMS(args.conf)
     ems.Run()
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+# Replay inverter history exported from VictoriaMetrics through the ems load
+# checks, faster than real time, to tune the load conditions offline.
+
+import argparse
+import csv
+import json
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy
+import gpiozero
+from gpiozero.pins.mock import MockFactory
+
+from ems import (
+    EMS,
+    METRICS,
+    ACQUIRED_GROUPS,
+    WINDOWS,
+    Clock,
+    Config,
+    DatingMetrics,
+    MeasurementsName,
+)
+
+
+def ReadExport(path):
+    # yield (metric, timestamps, values) blocks of a /api/v1/export file, one
+    # JSON object per line, timestamps in milliseconds
+    series = {}
+    with open(path, "r") as export:
+        for line in export:
+            if not line.strip():
+                continue
+            block = json.loads(line)
+            item = block["metric"].get("__name__")
+            # keep the first serie like ems does
+            if series.setdefault(item, block["metric"]) != block["metric"]:
+                continue
+            yield item, [t / 1000 for t in block["timestamps"]], block["values"]
+
+
+def ReadCsv(path):
+    # yield (metric, timestamps, values) rows of a /api/v1/export/csv file
+    # exported with format=__name__,__timestamp__:unix_s,__value__
+    with open(path, "r", newline="") as export:
+        for row in csv.reader(export):
+            if len(row) != 3:
+                continue
+            try:
+                yield row[0], [float(row[1])], [float(row[2])]
+            except ValueError:
+                # header
+                continue
+
+
+def LoadSeries(path):
+    # {metric: (timestamps, values)} sorted by time, from an export file
+    read = ReadCsv if path.endswith(".csv") else ReadExport
+    blocks = {}
+    for item, timestamps, values in read(path):
+        block = blocks.setdefault(item, ([], []))
+        block[0].extend(timestamps)
+        block[1].extend(values)
+    series = {}
+    for item, (timestamps, values) in blocks.items():
+        timestamps = numpy.asarray(timestamps, dtype=float)
+        values = numpy.asarray(values, dtype=float)
+        order = numpy.argsort(timestamps, kind="stable")
+        series[item] = (timestamps[order], values[order])
+    return series
+
+
+def LastValues(series, times):
+    # newest sample at or before each time, NaN and time 0 before the first
+    timestamps, values = series
+    index = numpy.searchsorted(timestamps, times, side="right") - 1
+    valid = index >= 0
+    index = index.clip(0)
+    return (
+        numpy.where(valid, values[index], numpy.nan),
+        numpy.where(valid, timestamps[index], 0),
+    )
+
+
+def MeanValues(series, times, window):
+    # avg_over_time over (time - window, time] for each time, NaN when the
+    # window holds no sample
+    timestamps, values = series
+    sums = numpy.concatenate(([0.0], numpy.cumsum(values)))
+    high = numpy.searchsorted(timestamps, times, side="right")
+    low = numpy.searchsorted(timestamps, times - window, side="right")
+    count = high - low
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.where(count > 0, (sums[high] - sums[low]) / count, numpy.nan)
+
+
+def Measurements(series, times, conf):
+    # {measurement dict name: (columns, rows)} where rows holds one row of
+    # doubles per replayed time, in the order of the snapshot values, so a
+    # step copies a row at once. Computed at once for the whole history
+    missing = (
+        numpy.full(len(times), numpy.nan),
+        numpy.zeros(len(times)),
+    )
+    empty = (numpy.array([]), numpy.array([]))
+    config = Config(conf)
+    # seconds of the mean windows, as the EMS reads them
+    mean = config.mean
+    dated = DatingMetrics(config)
+    measurements = {}
+    for group in ACQUIRED_GROUPS:
+        for window in WINDOWS:
+            columns = ["time"] + METRICS[group]
+            if window == "last":
+                last = {
+                    item: (
+                        LastValues(series[item], times) if item in series else missing
+                    )
+                    for item in METRICS[group]
+                }
+                # dated like the EMS dates the group
+                values = [
+                    numpy.minimum.reduce([last[item][1] for item in dated[group]])
+                ]
+                values += [last[item][0] for item in METRICS[group]]
+            else:
+                values = [times] + [
+                    MeanValues(series.get(item, empty), times, mean[window])
+                    for item in METRICS[group]
+                ]
+            measurements[MeasurementsName(window, group)] = (
+                columns,
+                numpy.ascontiguousarray(numpy.column_stack(values), dtype=float),
+            )
+    return measurements
+
+
+class ReplayClock(Clock):
+    # clock of the replayed EMS, both monotonic and wall time follow the
+    # replayed timestamp
+    def __init__(self, timestamp=0):
+        self.timestamp = timestamp
+
+    def Monotonic(self):
+        return self.timestamp
+
+    def Time(self):
+        return self.timestamp
+
+    def Now(self):
+        return datetime.fromtimestamp(self.timestamp)
+
+    def Sleep(self, duration):
+        self.timestamp += duration
+
+
+def LoadEms(conf, clock=None):
+    # instantiate an EMS from a conf dict, relays on mock pins
+    if not isinstance(gpiozero.Device.pin_factory, MockFactory):
+        gpiozero.Device.pin_factory = MockFactory()
+    with tempfile.NamedTemporaryFile("w", suffix=".conf") as conffile:
+        json.dump(conf, conffile)
+        conffile.flush()
+        return EMS(conffile.name, clock)
+
+
+def Days(times):
+    # (day, first index, end index) of each local day of times
+    day = datetime.fromtimestamp(times[0]).date()
+    last = datetime.fromtimestamp(times[-1]).date()
+    while day <= last:
+        midnight = datetime.combine(day, datetime.min.time())
+        start, end = numpy.searchsorted(
+            times,
+            [midnight.timestamp(), (midnight + timedelta(days=1)).timestamp()],
+        )
+        yield day, start, end
+        day += timedelta(days=1)
+
+
+def Times(series, step, start=None, end=None):
+    # replayed times, every step seconds over the acquired metrics history
+    acquired = [
+        series[item]
+        for group in ACQUIRED_GROUPS
+        for item in METRICS[group]
+        if item in series and len(series[item][0])
+    ]
+    if not acquired:
+        raise ValueError("no sample of the acquired metrics")
+    if start is None:
+        start = min(timestamps[0] for timestamps, _ in acquired)
+    if end is None:
+        end = max(timestamps[-1] for timestamps, _ in acquired)
+    return numpy.arange(start, end + step / 2, step)
+
+
+def Simulate(conf, times, measurements):
+    # run the load checks of conf at each time, return the EMS (relays
+    # closed) and the {load: on state at each time} arrays
+    clock = ReplayClock(float(times[0]))
+    conf = json.loads(json.dumps(conf))
+    # decisions are reported by the timelines, not logged
+    conf["logging"] = {"syslog": False, "console": False}
+    # nor journaled over the state of the running ems
+    conf.pop("journal", None)
+    ems = LoadEms(conf, clock)
+    states = {name: numpy.zeros(len(times), dtype=bool) for name in ems.loads}
+    # the rows of Measurements are in the order of the snapshot values and
+    # copied through a view of them
+    snapshots = [
+        (memoryview(getattr(ems, name).values), rows)
+        for name, (_, rows) in measurements.items()
+    ]
+
+    try:
+        for index, timestamp in enumerate(times.tolist()):
+            clock.timestamp = timestamp
+            for snapshot, rows in snapshots:
+                snapshot[:] = rows[index]
+            ems.CheckLoads()
+            for name, load in ems.loads.items():
+                states[name][index] = load.state["on"]
+    finally:
+        for load in ems.loads.values():
+            load.relay.close()
+    return ems, states
+
+
+def Trips(ems):
+    # {load: {reason: count}}
+    trips = {}
+    for (name, labels), count in ems.instrumentation.counters.items():
+        if name == "ems_load_trips_total":
+            labels = dict(labels)
+            trips.setdefault(labels["load"], {})[labels["reason"]] = count
+    return trips
+
+
+def Replay(conf, series, step=None, start=None, end=None):
+    # run the load checks of conf every step seconds over the history of
+    # series, return the relay timelines, daily runtimes and trips
+    if step is None:
+        step = float(conf.get("scheduler", {}).get("period", 2))
+    times = Times(series, step, start, end)
+    ems, states = Simulate(conf, times, Measurements(series, times, conf))
+
+    report = {
+        "start": float(times[0]),
+        "end": float(times[-1]),
+        "step": step,
+        "loads": {},
+    }
+    trips = Trips(ems)
+    for name, load in ems.loads.items():
+        state = states[name]
+        # indexes where the relay changed, the first one included
+        changes = numpy.flatnonzero(numpy.diff(state, prepend=False))
+        max_daily_run = load.conf.max_daily_run
+        daily = []
+        for day, first, last in Days(times):
+            hours = numpy.count_nonzero(state[first:last]) * step / 3600
+            daily.append(
+                {
+                    "day": day.isoformat(),
+                    "hours": hours,
+                    "max_daily_run": max_daily_run,
+                    "exceeded": max_daily_run is not None and hours > max_daily_run,
+                }
+            )
+        report["loads"][name] = {
+            "timeline": [
+                (float(times[change]), bool(state[change]))
+                for change in changes.tolist()
+            ],
+            "hours": numpy.count_nonzero(state) * step / 3600,
+            "daily": daily,
+            "trips": trips.get(name, {}),
+        }
+    return report
+
+
+def Override(conf, path, value):
+    # set a dotted path of conf, value is parsed as JSON when possible
+    keys = path.split(".")
+    for key in keys[:-1]:
+        conf = conf.setdefault(key, {})
+    try:
+        conf[keys[-1]] = json.loads(value)
+    except ValueError:
+        conf[keys[-1]] = value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--conf", required=True)
+    parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        help="VictoriaMetrics export, JSON lines or .csv",
+    )
+    parser.add_argument("--step", type=float, help="seconds between two checks")
+    parser.add_argument(
+        "-s",
+        "--set",
+        action="append",
+        default=[],
+        metavar="PATH=VALUE",
+        help="override a conf value, e.g. heater.on_condition.battery_voltage=26.5",
+    )
+    parser.add_argument("--timeline", help="write the relay changes to this csv")
+    args = parser.parse_args()
+
+    with open(args.conf, "r") as jsonfile:
+        conf = json.load(jsonfile)
+    for override in args.set:
+        path, value = override.split("=", 1)
+        Override(conf, path, value)
+
+    report = Replay(conf, LoadSeries(args.input), args.step)
+    if args.timeline:
+        with open(args.timeline, "w", newline="") as timeline:
+            writer = csv.writer(timeline)
+            writer.writerow(["load", "time", "on"])
+            for name, load in report["loads"].items():
+                for timestamp, on in load["timeline"]:
+                    writer.writerow([name, timestamp, int(on)])
+    for name, load in report["loads"].items():
+        print(
+            "{}: {} changes, {:.2f} h on, trips {}".format(
+                name,
+                len(load["timeline"]),
+                load["hours"],
+                json.dumps(load["trips"], sort_keys=True),
+            )
+        )
+        for day in load["daily"]:
+            print(
+                "  {} {:6.2f} h{}".format(
+                    day["day"],
+                    day["hours"],
+                    " > max_daily_run" if day["exceeded"] else "",
+                )
+            )
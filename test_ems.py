@@ -1,14 +1,89 @@
 import unittest
+import math
 from datetime import datetime, timedelta
 import time
+import json
+import os
+import syslog
+import tempfile
+import threading
+from unittest import mock
 
-from ems import EMS
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ems import (
+    EMS,
+    METRICS,
+    WINDOW_LABEL,
+    WINDOWS,
+    AcquisitionError,
+    Backend,
+    InfluxDB,
+    VictoriaMetrics,
+    RollingMean,
+    Snapshot,
+    Clock,
+    CycleScheduler,
+    Relay,
+    Instrumentation,
+    Logger,
+    CompileCondition,
+    CompileRules,
+    Config,
+    ConfigError,
+    FetchPlan,
+    LoadConfig,
+    ParseLineProtocol,
+    RecordingRules,
+)
 import gpiozero
 from gpiozero.pins.mock import MockFactory
 
 gpiozero.Device.pin_factory = MockFactory()
 
 
+class FakeClock(Clock):
+    # clock which only moves when slept, its wall time starts now
+    def __init__(self):
+        self.now = float(0)
+        self.start = datetime.now().timestamp()
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, duration):
+        self.now += duration
+
+    def Monotonic(self):
+        return self.now
+
+    def Time(self):
+        return self.start + self.now
+
+    def Now(self):
+        return datetime.fromtimestamp(self.Time())
+
+    def Sleep(self, duration):
+        self.sleep(duration)
+
+
+def LoadEms(path, update, clock=None):
+    # load an EMS from a test config with some sections updated
+    with open(path, "r") as jsonfile:
+        conf = json.load(jsonfile)
+    for section, values in update.items():
+        if isinstance(values, dict):
+            conf.setdefault(section, {}).update(values)
+        else:
+            conf[section] = values
+    with tempfile.NamedTemporaryFile("w", suffix=".conf") as conffile:
+        json.dump(conf, conffile)
+        conffile.flush()
+        return EMS(conffile.name, clock)
+
+
 class TestEmsConf(unittest.TestCase):
     def setUp(self):
         self.ems = EMS("ems-test-hydro-conf.conf")
@@ -24,10 +99,115 @@ class TestEmsConf(unittest.TestCase):
         self.assertTrue(self.ems.hydro["enable"])
 
 
+class TestConfig(unittest.TestCase):
+    def Conf(self):
+        with open("ems-test.conf", "r") as jsonfile:
+            return json.load(jsonfile)
+
+    def test_Shipped(self):
+        for path in ["ems.conf", "ems-test.conf", "ems-test-hydro-conf.conf"]:
+            LoadConfig(path)
+
+    def test_Typed(self):
+        config = Config(self.Conf())
+        self.assertEqual(config.url, "localhost:8086")
+        # seconds
+        self.assertEqual(config.mean, {"short": 1200, "long": 600})
+        heater, hydro = config.loads
+        self.assertEqual(heater.timeout, 60)
+        self.assertEqual(heater.dwell, 300)
+        self.assertEqual(heater.daily_run_limit, 3 * 3600)
+        self.assertIsNone(hydro.daily_run_limit)
+        self.assertIsNone(config.metrics)
+        self.assertEqual(config.metrics_job, "ems")
+        self.assertEqual(config.log_size, 1000)
+        self.assertTrue(config.log_syslog)
+        with self.assertRaises(AttributeError):
+            heater.unknown = 1
+
+    def test_Errors(self):
+        for section, key, value, message in [
+            ("victoria", "port", "http", "victoria.port: expected an integer"),
+            ("mean", "short", 1.5, "mean.short: expected an integer"),
+            ("victoria", "batch", "yes", "victoria.batch: expected a boolean"),
+            ("heater", "state_timer", None, "heater.state_timer: expected"),
+            ("heater", "off_condition", [], "heater.off_condition: expected a"),
+            ("scheduler", "period", 0, "scheduler.period: expected a positive"),
+            ("scheduler", "safety_period", -1, "scheduler.safety_period: expected"),
+            ("mean", "long", -10, "mean.long: expected a positive number"),
+            ("instrumentation", "port", "metrics", "instrumentation.port: expected"),
+            ("instrumentation", "push_period", 0, "instrumentation.push_period"),
+        ]:
+            conf = self.Conf()
+            conf.setdefault(section, {})[key] = value
+            with self.assertRaises(ConfigError) as context:
+                Config(conf)
+            self.assertIn(message, str(context.exception))
+        conf = self.Conf()
+        del conf["mean"]
+        with self.assertRaisesRegex(ConfigError, "mean: missing section"):
+            Config(conf)
+        conf = self.Conf()
+        conf["heater"]["off_condition"]["long"]["load_limit"] = "high"
+        with self.assertRaisesRegex(ConfigError, "heater: invalid rules"):
+            Config(conf)
+        # the legacy condition sections are checked like the other ones
+        for load, path, key, value, message in [
+            (
+                "heater",
+                ["off_condition"],
+                "short",
+                "x",
+                "off_condition.short: expected",
+            ),
+            ("heater", ["off_condition"], "shrot", {}, "unknown option shrot"),
+            ("heater", ["off_condition", "long"], "input_pwr", 1, "unknown option"),
+            ("heater", [], "on_condition", [], "heater.on_condition: expected a"),
+            ("heater", ["on_condition"], "battery_volt", 26, "unknown option"),
+            ("hydro", ["off_condition"], "short", {}, "unknown option short"),
+        ]:
+            conf = self.Conf()
+            section = conf[load]
+            for name in path:
+                section = section[name]
+            section[key] = value
+            with self.assertRaisesRegex(ConfigError, message):
+                Config(conf)
+        conf = self.Conf()
+        del conf["heater"]["off_condition"]["short"]["load_limit"]
+        with self.assertRaisesRegex(ConfigError, "missing off_condition.short"):
+            Config(conf)
+
+    def test_LegacyMean(self):
+        # confs of the former ems-influx.py have no mean section
+        conf = self.Conf()
+        del conf["mean"]
+        conf["heater"]["off_condition"]["short"]["mean"] = "15"
+        config = Config(conf)
+        self.assertEqual(config.mean, {"short": 15, "long": 600})
+        rules = RecordingRules(config)
+        self.assertIn("record: ems:battery_DC_V:avg_15s", rules)
+        self.assertIn("expr: avg_over_time(battery_DC_V[15s])", rules)
+        influx = InfluxDB("localhost", 8086, "root", "root", "ems")
+        self.assertEqual(
+            influx.MeanQuery("out", 15),
+            "SELECT MEAN(*) FROM out WHERE time > now() - 15s",
+        )
+        influx.close()
+
+    def test_InvalidJson(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".conf") as conffile:
+            conffile.write('{"victoria": {"url": "localhost" "port": 8086}}')
+            conffile.flush()
+            with self.assertRaisesRegex(ConfigError, "invalid JSON.*line 1"):
+                LoadConfig(conffile.name)
+
+
 class TestEms(unittest.TestCase):
     def setUp(self):
-        self.ems = EMS("ems-test.conf")
-        now = datetime.now().timestamp()
+        self.clock = FakeClock()
+        self.ems = EMS("ems-test.conf", self.clock)
+        now = self.clock.Time()
 
         self.ems.last_battery_measurements = {
             "time": now,
@@ -113,39 +293,49 @@ class TestEms(unittest.TestCase):
         self.assertFalse(self.ems.heater["on"])
 
     def test_StartHeater_Timer(self):
-        time = datetime.now()
-        self.ems.run_timer = time
+        start = self.clock.Monotonic()
+        self.ems.run_timer = start
         self.ems.heater["on"] = True
+        self.clock.sleep(1)
         self.ems.StartHeater()
-        self.assertEqual(self.ems.run_timer, time)
+        self.assertEqual(self.ems.run_timer, start)
         self.ems.heater["on"] = False
         self.ems.StartHeater()
-        self.assertNotEqual(self.ems.run_timer, time)
+        self.assertEqual(self.ems.run_timer, start + 1)
 
     def test_Heater_Timer(self):
         self.ems.heater["on"] = False
         self.ems.StartHeater()
-        time.sleep(1)
+        self.clock.sleep(1)
         self.ems.StopHeater()
-        self.assertEqual(int(self.ems.heater["heating_time_counter"]), 1)
+        self.assertEqual(self.ems.heater["heating_time_counter"], 1)
 
         self.ems.heater["on"] = False
         self.ems.StartHeater()
-        time.sleep(2)
+        self.clock.sleep(2)
         self.ems.StopHeater()
-        self.assertEqual(int(self.ems.heater["heating_time_counter"]), 3)
+        self.assertEqual(self.ems.heater["heating_time_counter"], 3)
+
+    def test_WallClockJump(self):
+        self.ems.StartHeater()
+        # NTP steps the wall clock back one hour while the heater runs
+        self.clock.start -= 3600
+        self.clock.sleep(5)
+        self.ems.StopHeater()
+        self.assertEqual(self.ems.heater["heating_time_counter"], 5)
 
     def test_Heater_Timer_Reset(self):
         self.ems.heater["heating_time_counter"] = 1000
         self.ems.CheckHeater()
         self.assertEqual(self.ems.heater["heating_time_counter"], 1000)
-        self.ems.heater["heating_time_reset"] = datetime.now() - timedelta(days=1)
+        self.ems.heater["heating_time_reset"] = self.clock.Now() - timedelta(days=1)
         self.ems.CheckHeater()
         self.assertEqual(self.ems.heater["heating_time_counter"], 0)
 
     def test_Heater_Timer_Stop(self):
         self.ems.heater["on"] = True
-        self.ems.heater["off_condition"]["max_daily_run"] = 1
+        # one hour, thresholds are converted to seconds at load time
+        self.ems.loads["heater"].conf.daily_run_limit = 3600
         self.ems.heater["heating_time_counter"] = 3500
         self.ems.CheckHeater()
         self.assertTrue(self.ems.heater["on"])
@@ -154,6 +344,1334 @@ class TestEms(unittest.TestCase):
         self.ems.CheckHeater()
         self.assertFalse(self.ems.heater["on"])
 
+    def test_SafetyShortTrip(self):
+        self.ems.heater["on"] = True
+        self.ems.CheckSafety()
+        self.assertTrue(self.ems.heater["on"])
+        self.ems.short_mean_out_measurements["out_load_watt"] = 3000
+        self.ems.CheckSafety()
+        self.assertFalse(self.ems.heater["on"])
+
+    def test_SafetyIgnoresLong(self):
+        self.ems.heater["on"] = True
+        self.ems.long_mean_out_measurements["out_load_watt"] = 3000
+        self.ems.CheckSafety()
+        self.assertTrue(self.ems.heater["on"])
+        self.ems.CheckHeater()
+        self.assertFalse(self.ems.heater["on"])
+
+    def test_HeaterStartRule(self):
+        # dwell timers are monotonic
+        self.ems.heater["timer"] = self.clock.Monotonic() - 600
+        self.ems.CheckHeater()
+        self.assertFalse(self.ems.heater["on"])
+        self.ems.last_battery_measurements["battery_DC_V"] = 26.5
+        self.ems.last_pv_measurements["pv_W"] = 500
+        self.ems.CheckHeater()
+        self.assertTrue(self.ems.heater["on"])
+
+
+class TestRules(unittest.TestCase):
+    def setUp(self):
+        self.ems = mock.Mock()
+        self.ems.short_mean_out_measurements = {"out_load_watt": 2000}
+        self.ems.last_battery_measurements = {"battery_DC_V": 25}
+
+    def test_Condition(self):
+        predicate, dependencies = CompileCondition(
+            {"metric": "out_load_watt", "window": "short", "op": ">", "value": "1500"}
+        )
+        self.assertTrue(predicate(self.ems))
+        self.assertEqual(dependencies, [("short", "out_load_watt")])
+        self.ems.short_mean_out_measurements["out_load_watt"] = 1500
+        self.assertFalse(predicate(self.ems))
+
+    def test_Combinators(self):
+        load = {"metric": "out_load_watt", "window": "short", "op": ">", "value": 2500}
+        battery = {"metric": "battery_DC_V", "op": "<=", "value": 25}
+        predicate, dependencies = CompileCondition({"any": [load, battery]})
+        self.assertTrue(predicate(self.ems))
+        self.assertEqual(
+            dependencies, [("short", "out_load_watt"), ("last", "battery_DC_V")]
+        )
+        predicate, _ = CompileCondition({"all": [load, {"any": [battery]}]})
+        self.assertFalse(predicate(self.ems))
+        for condition in [{"any": []}, {"all": []}, {"all": load}]:
+            with self.assertRaises(ValueError):
+                CompileCondition(condition)
+
+    def test_Invalid(self):
+        for condition in [
+            {"metric": "unknown", "op": ">", "value": 1},
+            {"metric": "pv_W", "op": "=>", "value": 1},
+            {"metric": "pv_W", "window": "daily", "op": ">", "value": 1},
+            {"metric": "pv_W", "op": ">", "value": "high"},
+            {"metric": "pv_W", "op": ">"},
+        ]:
+            with self.assertRaises(ValueError):
+                CompileCondition(condition)
+
+    def test_ConfigRules(self):
+        ems = LoadEms(
+            "ems-test.conf",
+            {
+                "heater": {
+                    "rules": {
+                        "short": {
+                            "metric": "out_load_percent",
+                            "window": "last",
+                            "op": ">",
+                            "value": 80,
+                        }
+                    }
+                }
+            },
+        )
+        _, dependencies = ems.heater["rules"]["short"]
+        self.assertEqual(dependencies, [("last", "out_load_percent")])
+        # stages which are not given keep the off_condition/on_condition ones
+        _, dependencies = ems.heater["rules"]["long"]
+        self.assertIn(("long", "pv_W"), dependencies)
+
+    def test_LoadRules(self):
+        # loads without legacy conditions need an on rule
+        with self.assertRaises(ValueError):
+            CompileRules("pump", {"off_condition": {}})
+        rules = CompileRules(
+            "pump", {"rules": {"on": {"metric": "pv_W", "op": ">", "value": 100}}}
+        )
+        self.assertFalse(rules["short"][0](self.ems))
+        self.assertEqual(rules["on"][1], [("last", "pv_W")])
+
+    def test_LegacyKeys(self):
+        # a missing or misspelled legacy key is an error, not a dropped condition
+        with open("ems-test.conf", "r") as jsonfile:
+            text = jsonfile.read()
+        for load, path, key in [
+            ("heater", ["on_condition"], None),
+            ("heater", ["on_condition"], "input_power"),
+            ("heater", ["off_condition"], "short"),
+            ("heater", ["off_condition", "long"], "load_limit"),
+            ("hydro", ["on_condition"], "output_power_limit"),
+            ("hydro", ["off_condition", "long"], "battery_voltage_limit"),
+        ]:
+            broken = json.loads(text)[load]
+            section = broken
+            for name in path[:-1]:
+                section = section[name]
+            if key is None:
+                del section[path[-1]]
+            else:
+                section = section[path[-1]]
+                section[key + "s"] = section.pop(key)
+            with self.assertRaises(ValueError):
+                CompileRules(load, broken)
+        # the legacy keys of a stage given by the rules are not needed
+        broken = json.loads(text)["heater"]
+        del broken["on_condition"]
+        broken["rules"] = {"on": {"metric": "pv_W", "op": ">", "value": 100}}
+        self.assertEqual(CompileRules("heater", broken)["on"][1], [("last", "pv_W")])
+
+
+class TestLoads(unittest.TestCase):
+    def setUp(self):
+        self.ems = LoadEms(
+            "ems-test.conf",
+            {
+                "heater": {"priority": 1, "power": 2000},
+                "loads": [
+                    {
+                        "name": "pump",
+                        "relay_pin": 22,
+                        "state_timer": 5,
+                        "priority": 2,
+                        "power": 500,
+                        "rules": {"on": {"metric": "pv_W", "op": ">", "value": 100}},
+                    }
+                ],
+            },
+        )
+        now = datetime.now().timestamp()
+        for window in ["last", "short", "long"]:
+            prefix = "last" if window == "last" else "{}_mean".format(window)
+            setattr(
+                self.ems,
+                "{}_battery_measurements".format(prefix),
+                {"time": now, "battery_DC_V": 26.5},
+            )
+            setattr(
+                self.ems,
+                "{}_pv_measurements".format(prefix),
+                {"time": now, "pv_W": 3000},
+            )
+            setattr(
+                self.ems,
+                "{}_out_measurements".format(prefix),
+                {"time": now, "out_load_watt": 500},
+            )
+        self.pump = self.ems.loads["pump"]
+
+    def tearDown(self):
+        del self.pump
+        del self.ems
+
+    def test_Allocation(self):
+        self.assertEqual(
+            [load.name for load in self.ems.allocation], ["pump", "heater", "hydro"]
+        )
+        self.assertEqual(self.ems.PowerBudget(), 2500)
+
+    def test_PriorityFirst(self):
+        # 2000 W of surplus: the pump takes 500 W, not enough left for the heater
+        self.ems.short_mean_pv_measurements["pv_W"] = 2500
+        self.ems.CheckLoads()
+        self.assertTrue(self.pump.state["on"])
+        self.assertFalse(self.ems.heater["on"])
+        self.ems.short_mean_pv_measurements["pv_W"] = 3000
+        self.ems.CheckLoads()
+        self.assertTrue(self.ems.heater["on"])
+
+    def test_Shedding(self):
+        self.ems.CheckLoads()
+        self.assertTrue(self.pump.state["on"])
+        self.assertTrue(self.ems.heater["on"])
+        # running loads are part of the output load
+        self.ems.short_mean_out_measurements["out_load_watt"] = 2500
+        self.assertEqual(self.ems.PowerBudget(), 3000)
+        self.ems.short_mean_pv_measurements["pv_W"] = 2700
+        self.ems.CheckLoads()
+        self.assertTrue(self.ems.heater["on"])
+        # the lowest priority load is shed first
+        self.ems.short_mean_pv_measurements["pv_W"] = 2400
+        self.ems.CheckLoads()
+        self.assertTrue(self.pump.state["on"])
+        self.assertFalse(self.ems.heater["on"])
+
+    def test_Dwell(self):
+        self.ems.CheckLoads()
+        self.pump.Stop()
+        self.pump.state["timer"] = self.ems.clock.Monotonic()
+        self.ems.CheckLoads()
+        self.assertFalse(self.pump.state["on"])
+        self.pump.state["timer"] = self.ems.clock.Monotonic() - 600
+        self.ems.CheckLoads()
+        self.assertTrue(self.pump.state["on"])
+
+
+class TestEmsBatch(unittest.TestCase):
+    def setUp(self):
+        self.ems = LoadEms("ems-test.conf", {"victoria": {"batch": True}})
+        self.now = datetime.now().timestamp()
+        self.vector = []
+        for window, offset in [("last", 0), ("short", 1), ("long", 2)]:
+            for group in ["battery", "pv", "out"]:
+                for i, item in enumerate(METRICS[group]):
+                    self.vector.append(
+                        {
+                            "metric": {"__name__": item, WINDOW_LABEL: window},
+                            "value": [self.now, str(i + offset)],
+                        }
+                    )
+
+    def tearDown(self):
+        del self.ems
+
+    def test_BatchQuery(self):
+        windows = self.ems.Windows(WINDOWS)
+        query = self.ems.victoria.BatchQuery(["battery"], windows)
+        # the battery voltage is the only battery metric the rules read
+        self.assertIn('{__name__=~"battery_DC_V"}', query)
+        self.assertNotIn("battery_charging_current", query)
+        query = self.ems.victoria.BatchQuery(["out", "pv"], {"long": 600})
+        self.assertIn('{__name__=~"out_load_watt|pv_W"}', query)
+        query = self.ems.victoria.BatchQuery(["battery"], windows)
+        self.assertIn("[20m]", query)
+        self.assertIn("[10m]", query)
+        self.assertEqual(query.count(" or "), 2)
+
+    def test_BatchDemux(self):
+        with mock.patch.object(
+            self.ems.victoria, "QueryVector", return_value=self.vector
+        ) as query:
+            self.assertTrue(self.ems.GetData())
+        self.assertEqual(query.call_count, 1)
+        self.assertEqual(self.ems.last_battery_measurements["battery_DC_V"], 0)
+        self.assertEqual(self.ems.short_mean_battery_measurements["battery_DC_V"], 1)
+        self.assertEqual(self.ems.long_mean_out_measurements["out_load_watt"], 6)
+        # no rule reads it
+        self.assertTrue(math.isnan(self.ems.short_mean_pv_measurements["pv_A"]))
+        self.assertEqual(self.ems.last_out_measurements["time"], self.now)
+
+    def test_BatchSafety(self):
+        fast = [
+            serie
+            for serie in self.vector
+            if serie["metric"][WINDOW_LABEL] in ("last", "short")
+        ]
+        with mock.patch.object(
+            self.ems.victoria, "QueryVector", return_value=fast
+        ) as query:
+            self.assertTrue(self.ems.AcquireSafety())
+        # the short means the trip conditions read, not the long ones
+        self.assertIn("[20m]", query.call_args.args[0])
+        self.assertNotIn("[10m]", query.call_args.args[0])
+        self.assertEqual(self.ems.last_pv_measurements["pv_W"], 2)
+        self.assertEqual(self.ems.short_mean_out_measurements["out_load_watt"], 5)
+
+    def test_BatchMissing(self):
+        with mock.patch.object(
+            self.ems.victoria, "QueryVector", return_value=self.vector[1:]
+        ):
+            with self.assertRaises(Exception):
+                self.ems.GetData()
+        # nothing is published from an incomplete answer
+        self.assertEqual(self.ems.last_pv_measurements["time"], 0)
+
+    def test_BatchLocked(self):
+        # measurements are only published under the lock the checks hold
+        with mock.patch.object(
+            self.ems.victoria, "QueryVector", return_value=self.vector
+        ):
+            with self.ems.lock:
+                thread = threading.Thread(target=self.ems.GetData)
+                thread.start()
+                thread.join(0.2)
+                self.assertTrue(thread.is_alive())
+                self.assertEqual(self.ems.last_pv_measurements["time"], 0)
+            thread.join()
+        self.assertEqual(self.ems.last_pv_measurements["time"], self.now)
+
+    def test_BatchInPlace(self):
+        snapshot = self.ems.short_mean_out_measurements
+        with mock.patch.object(
+            self.ems.victoria, "QueryVector", return_value=self.vector
+        ):
+            self.ems.GetData()
+            for serie in self.vector:
+                if serie["metric"] == {
+                    "__name__": "out_load_watt",
+                    WINDOW_LABEL: "short",
+                }:
+                    serie["value"][1] = "7"
+            self.ems.GetData()
+        self.assertIs(self.ems.short_mean_out_measurements, snapshot)
+        self.assertEqual(snapshot["out_load_watt"], 7)
+
+
+class TestSnapshot(unittest.TestCase):
+    def test_Snapshot(self):
+        snapshot = Snapshot("pv")
+        self.assertEqual(snapshot["time"], 0)
+        self.assertTrue(math.isnan(snapshot["pv_W"]))
+        snapshot.Set({"time": 10, "pv_DC_V": 70, "pv_A": 2, "pv_W": 140})
+        self.assertEqual(snapshot["pv_W"], 140)
+        self.assertEqual(list(snapshot.values), [10, 70, 2, 140])
+        copy = snapshot.Copy()
+        snapshot["pv_W"] = 0
+        self.assertEqual(copy["pv_W"], 140)
+        self.assertEqual(
+            copy.AsDict(), {"time": 10, "pv_DC_V": 70, "pv_A": 2, "pv_W": 140}
+        )
+        self.assertIsNone(snapshot.get("battery_DC_V"))
+        with self.assertRaises(KeyError):
+            snapshot["battery_DC_V"] = 1
+        with self.assertRaises(AttributeError):
+            snapshot.extra = 1
+
+
+class StaticBackend(Backend):
+    # backend answering the same values, counting its calls
+    def __init__(self):
+        self.calls = []
+
+    def Values(self, group, value):
+        return dict(
+            [("time", time.time())] + [(item, value) for item in METRICS[group]]
+        )
+
+    def Last(self, groups):
+        self.calls.append(("last", groups))
+        return {group: self.Values(group, 1.0) for group in groups}
+
+    def Mean(self, groups, minutes):
+        self.calls.append((minutes, groups))
+        return {group: self.Values(group, float(minutes)) for group in groups}
+
+
+class TestBackend(unittest.TestCase):
+    def test_Injected(self):
+        backend = StaticBackend()
+        ems = EMS("ems-test.conf", backend=backend)
+        self.assertIsNone(ems.victoria)
+        ems.RefreshData()
+        self.assertEqual([minutes for minutes, _ in backend.calls], ["last", 1200, 600])
+        self.assertEqual(ems.last_pv_measurements["pv_W"], 1.0)
+        self.assertEqual(ems.short_mean_out_measurements["out_load_watt"], 1200.0)
+        self.assertEqual(ems.long_mean_battery_measurements["battery_DC_V"], 600.0)
+        ems.CheckLoads()
+
+    def test_Influx(self):
+        import bench_ems
+
+        server = bench_ems.FakeServer(bench_ems.FakeInfluxHandler).Start()
+        try:
+            ems = LoadEms(
+                "ems-test.conf",
+                {
+                    "victoria": None,
+                    "influx": {"port": server.server_address[1], "database": "ems"},
+                },
+            )
+            self.assertEqual(ems.config.backend, "influx")
+            server.Reset()
+            ems.RefreshData()
+            # every statement of the cycle in one request
+            self.assertEqual(server.requests, 1)
+            self.assertAlmostEqual(
+                ems.last_battery_measurements["battery_DC_V"], 26.5, delta=1
+            )
+            self.assertAlmostEqual(
+                ems.long_mean_out_measurements["out_load_watt"], 300, delta=10
+            )
+            self.assertLess(time.time() - ems.last_pv_measurements["time"], 60)
+            ems.CheckLoads()
+        finally:
+            server.Stop()
+
+    def test_Victoria(self):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {
+            "data": {"result": [{"metric": {}, "value": [100, "2"]}]}
+        }
+        session = mock.Mock()
+        session.get.return_value = response
+        instrumentation = Instrumentation()
+        backend = VictoriaMetrics(
+            session,
+            "http://victoria:8428",
+            (1, 5),
+            instrumentation,
+            RecordingLogger(instrumentation),
+            {("last", "pv"): ["pv_W"], ("long", "pv"): ["pv_W", "pv_A"]},
+        )
+        staging = {
+            (window, group): Snapshot(group)
+            for window in ["last", "long"]
+            for group in ["pv", "out"]
+        }
+        keys = backend.Fetch(["pv", "out"], {"last": None, "long": 600}, staging)
+        self.assertEqual(keys, [("last", "pv"), ("long", "pv")])
+        # filled in place, the metrics which are not planned are NaN
+        self.assertEqual(staging["last", "pv"]["time"], 100)
+        self.assertEqual(staging["last", "pv"]["pv_W"], 2.0)
+        self.assertTrue(math.isnan(staging["last", "pv"]["pv_A"]))
+        self.assertEqual(staging["long", "pv"]["pv_A"], 2.0)
+        # one query per planned metric
+        self.assertEqual(session.get.call_count, 3)
+        self.assertIn("avg_over_time%28pv_A%5B10m%5D%29", session.get.call_args.args[0])
+
+    def test_UnknownBackend(self):
+        with open("ems-test.conf", "r") as jsonfile:
+            conf = json.load(jsonfile)
+        conf["backend"] = "graphite"
+        with self.assertRaisesRegex(ConfigError, "backend: expected one of"):
+            Config(conf)
+
+
+class TestEmsQuery(unittest.TestCase):
+    def setUp(self):
+        self.ems = EMS("ems-test.conf")
+
+    def tearDown(self):
+        del self.ems
+
+    def test_QueryUrlPreEncoded(self):
+        victoria = self.ems.victoria
+        url = victoria.query_urls["avg_over_time(pv_W[10m])"]
+        self.assertTrue(url.startswith(victoria.query_url + "?query="))
+        self.assertIs(victoria.QueryUrl("avg_over_time(pv_W[10m])"), url)
+
+    def test_QueryTimeout(self):
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {
+            "data": {"result": [{"metric": {}, "value": [1, "2"]}]}
+        }
+        with mock.patch.object(self.ems.session, "get", return_value=response) as get:
+            self.assertEqual(self.ems.QueryVictoriaMetrics("pv_W"), [1, "2"])
+        get.assert_called_once_with(
+            self.ems.victoria.query_urls["pv_W"], timeout=self.ems.timeout
+        )
+
+    def test_QueryHttpError(self):
+        with mock.patch.object(
+            self.ems.session, "get", return_value=mock.Mock(status_code=503)
+        ):
+            with self.assertRaises(Exception):
+                self.ems.QueryVictoriaMetrics("pv_W")
+
+
+class TestEmsConcurrent(unittest.TestCase):
+    def setUp(self):
+        self.ems = EMS("ems-test.conf")
+        self.ems.concurrent = True
+        self.ems.executor = ThreadPoolExecutor(max_workers=9)
+        self.now = datetime.now().timestamp()
+
+    def tearDown(self):
+        self.ems.executor.shutdown(wait=True)
+        del self.ems
+
+    def query(self, delay=0, fail=None, slow=None):
+        def query(query):
+            time.sleep(delay if slow is None or slow in query else 0)
+            if fail is not None and fail in query:
+                raise Exception("failed {}".format(query))
+            return [self.now, "1"]
+
+        return query
+
+    def test_Concurrent(self):
+        with mock.patch.object(self.ems, "QueryVictoriaMetrics", self.query(0.1)):
+            start = time.monotonic()
+            self.assertTrue(self.ems.AcquireData())
+            elapsed = time.monotonic() - start
+        # the 8 queries of the cycle run in parallel
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(self.ems.last_out_measurements["out_load_watt"], 1)
+        self.assertEqual(self.ems.long_mean_pv_measurements["pv_W"], 1)
+
+    def test_ConcurrentFailure(self):
+        with mock.patch.object(
+            self.ems, "QueryVictoriaMetrics", self.query(fail="pv_W[10m]")
+        ):
+            with self.assertRaises(AcquisitionError) as error:
+                self.ems.AcquireData()
+        self.assertEqual(list(error.exception.failures), ["long mean pv"])
+
+    def test_ConcurrentDeadline(self):
+        self.ems.deadline = 0.2
+        with mock.patch.object(
+            self.ems, "QueryVictoriaMetrics", self.query(0.5, slow="out_load_watt")
+        ):
+            with self.assertRaises(AcquisitionError) as error:
+                self.ems.AcquireData()
+        # groups reading the slow metric can not finish before the deadline
+        self.assertIn("last out", error.exception.failures)
+        self.assertNotIn("last battery", error.exception.failures)
+        # nothing is published, even once the late groups finish
+        self.ems.executor.shutdown(wait=True)
+        self.assertEqual(self.ems.last_battery_measurements["time"], 0)
+        self.assertTrue(math.isnan(self.ems.last_out_measurements["out_load_watt"]))
+
+
+class TestEmsTiers(unittest.TestCase):
+    def setUp(self):
+        self.ems = EMS("ems-test.conf")
+        self.now = datetime.now().timestamp()
+
+    def tearDown(self):
+        del self.ems
+
+    def test_Tiers(self):
+        queries = []
+
+        def query(query):
+            queries.append(query)
+            return [self.now, "1"]
+
+        with mock.patch.object(self.ems.victoria, "Query", query):
+            self.ems.AcquireSafety()
+            fast = list(queries)
+            del queries[:]
+            self.ems.AcquireMeans()
+        # the safety tier refreshes the short means its trip conditions read
+        self.assertIn("avg_over_time(out_load_watt[20m])", fast)
+        self.assertIn("avg_over_time(battery_DC_V[20m])", fast)
+        self.assertFalse([query for query in fast if "[10m]" in query])
+        self.assertTrue(queries)
+        self.assertFalse([query for query in queries if "[10m]" not in query])
+
+
+class TestEmsRecorded(unittest.TestCase):
+    def setUp(self):
+        self.ems = LoadEms("ems-test.conf", {"victoria": {"recorded": True}})
+
+    def tearDown(self):
+        del self.ems
+
+    def test_RecordingRules(self):
+        rules = RecordingRules(self.ems.config, "30s")
+        self.assertIn("    interval: 30s\n", rules)
+        self.assertIn(
+            "      - record: ems:pv_W:avg_10m\n"
+            "        expr: avg_over_time(pv_W[10m])\n",
+            rules,
+        )
+        # only the means the rules read
+        self.assertNotIn("pv_A", rules)
+        self.assertNotIn("ems:pv_W:avg_20m", rules)
+
+    def test_Recorded(self):
+        recorded = [
+            {"metric": {"__name__": name}, "value": [100, "42"]}
+            for name in [
+                "ems:battery_DC_V:avg_10m",
+                "ems:battery_DC_V:avg_20m",
+                "ems:out_load_watt:avg_20m",
+                "ems:pv_W:avg_10m",
+            ]
+        ]
+        with mock.patch.object(
+            self.ems, "QueryVictoriaMetricsVector", return_value=recorded
+        ) as vector, mock.patch.object(
+            self.ems, "QueryVictoriaMetrics", return_value=[100, "1"]
+        ) as query:
+            self.ems.GetData(["short", "long"])
+        self.assertEqual(vector.call_count, 1)
+        self.assertIn("[180s]", vector.call_args.args[0])
+        self.assertEqual(self.ems.long_mean_pv_measurements["pv_W"], 42)
+        self.assertEqual(self.ems.short_mean_battery_measurements["battery_DC_V"], 42)
+        # not read by the rules, neither recorded nor fetched
+        self.assertTrue(math.isnan(self.ems.long_mean_pv_measurements["pv_A"]))
+        queries = [call.args[0] for call in query.call_args_list]
+        self.assertEqual(queries, ["avg_over_time(out_load_watt[10m])"])
+        # recorded but missing, falls back to the live mean
+        self.assertIn("avg_over_time(out_load_watt[10m])", queries)
+        self.assertEqual(self.ems.long_mean_out_measurements["out_load_watt"], 1)
+        self.assertEqual(
+            self.ems.instrumentation.counters[
+                (
+                    "ems_recorded_fallbacks_total",
+                    (("metric", "out_load_watt"), ("window", "long")),
+                )
+            ],
+            1,
+        )
+
+
+class TestFetchPlan(unittest.TestCase):
+    def test_Hydro(self):
+        _, config = LoadConfig("ems-test-hydro-conf.conf")
+        self.assertEqual(
+            FetchPlan(config),
+            {
+                ("last", "battery"): ["battery_DC_V"],
+                ("last", "pv"): ["pv_W"],
+                ("last", "out"): ["out_load_watt"],
+                ("long", "battery"): ["battery_DC_V"],
+            },
+        )
+        ems = EMS("ems-test-hydro-conf.conf")
+        with mock.patch.object(
+            ems.victoria, "Query", return_value=[time.time(), "1"]
+        ) as query:
+            ems.AcquireData()
+        # instead of 11 last values and 22 means
+        self.assertEqual(query.call_count, 4)
+        ems.CheckLoads()
+
+    def test_Watched(self):
+        # a group no rule reads is still fetched for the data timeout
+        _, config = LoadConfig("ems-test-hydro-conf.conf")
+        config.loads[0].rules = CompileRules(
+            "pump", {"rules": {"on": {"metric": "grid_AC_V", "op": ">", "value": 200}}}
+        )
+        plan = FetchPlan(config)
+        self.assertEqual(plan["last", "battery"], ["battery_DC_V"])
+        self.assertEqual(plan["last", "pv"], ["pv_DC_V"])
+        self.assertEqual(plan["last", "grid"], ["grid_AC_V"])
+        self.assertNotIn(("long", "battery"), plan)
+
+
+class TestRollingMean(unittest.TestCase):
+    def test_Mean(self):
+        rolling = RollingMean(10)
+        self.assertIsNone(rolling.Mean())
+        self.assertTrue(rolling.Add(0, 1))
+        self.assertTrue(rolling.Add(5, 3))
+        self.assertEqual(rolling.Mean(), 2)
+        # the sample at 0 is out of ]0, 10]
+        self.assertTrue(rolling.Add(10, 5))
+        self.assertEqual(rolling.Mean(), 4)
+        self.assertEqual(len(rolling), 2)
+
+    def test_OldSample(self):
+        rolling = RollingMean(10)
+        rolling.Add(5, 3)
+        self.assertFalse(rolling.Add(5, 100))
+        self.assertFalse(rolling.Add(4, 100))
+        self.assertEqual(rolling.Mean(), 3)
+
+    def test_Gap(self):
+        rolling = RollingMean(10)
+        rolling.Add(0, 1)
+        rolling.Add(1, 1)
+        rolling.Add(100, 7)
+        self.assertEqual(rolling.Mean(), 7)
+        self.assertEqual(len(rolling), 1)
+
+
+class TestCycleScheduler(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.scheduler = CycleScheduler(2, self.clock, self.clock.sleep)
+
+    def test_NoDrift(self):
+        starts = []
+        for work in [0.5, 1.9, 0, 1.2]:
+            self.scheduler.Wait()
+            starts.append(self.clock.now)
+            self.clock.now += work
+        self.assertEqual(starts, [0, 2, 4, 6])
+        self.assertEqual(self.scheduler.missed, 0)
+        self.assertEqual(self.scheduler.jitter_max, 0)
+
+    def test_Overrun(self):
+        self.scheduler.Wait()
+        # slightly late, the cycle runs right away
+        self.clock.now += 2.5
+        self.assertEqual(self.scheduler.Wait(), 0)
+        self.assertEqual(self.scheduler.jitter, 0.5)
+        # two whole periods late, they are skipped
+        self.clock.now += 6.2
+        self.assertEqual(self.scheduler.Wait(), 2)
+        self.assertAlmostEqual(self.scheduler.jitter, 0.7)
+        # back on the original grid
+        self.clock.now += 0.1
+        self.scheduler.Wait()
+        self.assertEqual(self.clock.now, 10)
+        stats = self.scheduler.Stats()
+        self.assertEqual(stats["cycles"], 4)
+        self.assertEqual(stats["missed"], 2)
+        self.assertAlmostEqual(stats["jitter_max"], 0.7)
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.instrumentation = Instrumentation()
+        self.relay = Relay("pump", 27, self.instrumentation, 60, self.clock)
+
+    def tearDown(self):
+        self.relay.close()
+
+    def Count(self, name):
+        return self.instrumentation.counters.get((name, (("relay", "pump"),)), 0)
+
+    def test_WriteOnChange(self):
+        for _ in range(3):
+            self.relay.on()
+        self.assertTrue(self.relay.value)
+        self.relay.off()
+        self.relay.off()
+        self.assertFalse(self.relay.value)
+        self.assertEqual(self.Count("ems_relay_writes_total"), 2)
+        self.assertEqual(self.Count("ems_relay_reads_total"), 0)
+
+    def test_Verify(self):
+        self.relay.on()
+        # the pin is driven low to energise the relay
+        self.relay.device.pin.state = True
+        self.relay.on()
+        self.assertFalse(self.relay.value)
+        self.clock.sleep(60)
+        self.relay.on()
+        self.assertTrue(self.relay.value)
+        self.assertEqual(self.Count("ems_relay_reads_total"), 1)
+        self.assertEqual(self.Count("ems_relay_corrections_total"), 1)
+        self.assertEqual(self.Count("ems_relay_writes_total"), 2)
+
+
+class TestEmsLocalMean(unittest.TestCase):
+    def setUp(self):
+        self.ems = LoadEms("ems-test.conf", {"mean": {"local": True}})
+        self.now = datetime.now().timestamp()
+        self.value = 0
+
+    def tearDown(self):
+        del self.ems
+
+    def query(self, query):
+        self.assertNotIn("avg_over_time", query)
+        return [self.now, str(self.value)]
+
+    def test_LocalMean(self):
+        with mock.patch.object(self.ems.victoria, "Query", self.query) as query:
+            for self.value in range(4):
+                self.ems.AcquireData()
+                self.now += 60
+        self.assertEqual(self.ems.last_battery_measurements["battery_DC_V"], 3)
+        self.assertEqual(self.ems.short_mean_battery_measurements["battery_DC_V"], 1.5)
+        self.assertEqual(self.ems.long_mean_out_measurements["out_load_watt"], 1.5)
+        self.assertEqual(
+            self.ems.long_mean_pv_measurements["time"],
+            self.ems.last_pv_measurements["time"],
+        )
+
+    def test_Grid(self):
+        # the grid is acquired with the other groups once a rule reads it
+        self.assertNotIn("grid", self.ems.groups)
+        rule = {"metric": "grid_Hz", "window": "short", "op": "<", "value": 49}
+        self.ems = None
+        self.ems = ems = LoadEms(
+            "ems-test.conf",
+            {"mean": {"local": True}, "heater": {"rules": {"short": rule}}},
+        )
+        self.assertIn("grid", ems.groups)
+        with mock.patch.object(ems.victoria, "Query", self.query):
+            for self.value in range(4):
+                ems.AcquireData()
+                self.now += 60
+        self.assertEqual(ems.last_grid_measurements["grid_Hz"], 3)
+        self.assertEqual(ems.short_mean_grid_measurements["grid_Hz"], 1.5)
+        self.assertTrue(ems.heater["rules"]["short"][0](ems))
+
+    def test_Backfill(self):
+        now_ms = int(self.now * 1000)
+        lines = [
+            json.dumps(
+                {
+                    "metric": {"__name__": "battery_DC_V", "job": "inverter"},
+                    "values": [24, 26],
+                    "timestamps": [now_ms - 15 * 60000, now_ms - 60000],
+                }
+            ).encode(),
+            b"",
+            json.dumps(
+                {
+                    "metric": {"__name__": "battery_DC_V", "job": "other"},
+                    "values": [0],
+                    "timestamps": [now_ms - 30000],
+                }
+            ).encode(),
+            json.dumps(
+                {
+                    "metric": {"__name__": "unknown"},
+                    "values": [0],
+                    "timestamps": [now_ms],
+                }
+            ).encode(),
+        ]
+        response = mock.MagicMock(status_code=200)
+        response.__enter__.return_value = response
+        response.iter_lines.return_value = iter(lines)
+        with mock.patch.object(self.ems.session, "get", return_value=response) as get:
+            self.assertTrue(self.ems.BackfillWindows())
+        self.assertTrue(get.call_args.kwargs["stream"])
+        self.assertIn("battery_DC_V", get.call_args.kwargs["params"]["match[]"])
+        windows = self.ems.windows["battery_DC_V"]
+        # short is 20 minutes and long 10 minutes in the test config
+        self.assertEqual(windows["short"].Mean(), 25)
+        self.assertEqual(windows["long"].Mean(), 26)
+
+    def test_Tiers(self):
+        with mock.patch.object(self.ems.victoria, "Query", self.query) as query:
+            self.value = 2
+            self.ems.AcquireSafety()
+            self.assertTrue(self.ems.AcquireMeans())
+        self.assertEqual(self.ems.short_mean_pv_measurements["pv_W"], 2)
+
+    def test_LocalMeanBatchQuery(self):
+        query = self.ems.victoria.BatchQuery(["pv"], {"last": None})
+        self.assertEqual(query.count(" or "), 0)
+
+
+class TestEmsIncremental(unittest.TestCase):
+    def setUp(self):
+        self.ems = LoadEms("ems-test.conf", {"victoria": {"incremental": True}})
+        self.now_ms = int(datetime.now().timestamp() * 1000)
+
+    def tearDown(self):
+        del self.ems
+
+    def export(self, timestamps, value):
+        lines = [
+            json.dumps(
+                {
+                    "metric": {"__name__": item},
+                    "values": [value] * len(timestamps),
+                    "timestamps": timestamps,
+                }
+            ).encode()
+            for group in ["battery", "pv", "out"]
+            for item in METRICS[group]
+        ]
+        response = mock.MagicMock(status_code=200)
+        response.__enter__.return_value = response
+        response.iter_lines.return_value = iter(lines)
+        return response
+
+    def test_Incremental(self):
+        self.assertTrue(self.ems.local_mean)
+        first = self.export([self.now_ms - 2000, self.now_ms - 1000], 1)
+        with mock.patch.object(self.ems.session, "get", return_value=first):
+            self.ems.AcquireData()
+        self.assertEqual(self.ems.last_pv_measurements["time"], self.now_ms / 1000 - 1)
+        self.assertEqual(self.ems.short_mean_pv_measurements["pv_W"], 1)
+
+        # the second export overlaps the first one by one sample
+        second = self.export([self.now_ms - 1000, self.now_ms], 4)
+        with mock.patch.object(self.ems.session, "get", return_value=second) as get:
+            self.ems.AcquireData()
+        self.assertEqual(
+            float(get.call_args.kwargs["params"]["start"]), self.now_ms / 1000 - 1
+        )
+        self.assertEqual(self.ems.last_out_measurements["out_load_watt"], 4)
+        self.assertEqual(self.ems.long_mean_out_measurements["out_load_watt"], 2)
+
+    def test_IncrementalStale(self):
+        response = self.export([self.now_ms], 1)
+        lines = list(response.iter_lines.return_value)
+        # out_Hz stopped reporting a week ago, no rule reads it
+        index = (METRICS["battery"] + METRICS["pv"] + METRICS["out"]).index("out_Hz")
+        stale = json.loads(lines[index])
+        stale["timestamps"] = [self.now_ms - 168 * 3600 * 1000]
+        lines[index] = json.dumps(stale).encode()
+        response.iter_lines.return_value = iter(lines)
+        with mock.patch.object(self.ems.session, "get", return_value=response):
+            self.ems.AcquireData()
+        self.assertEqual(self.ems.last_out_measurements["time"], self.now_ms / 1000)
+
+        with mock.patch.object(
+            self.ems.session, "get", return_value=self.export([self.now_ms], 1)
+        ) as get:
+            self.ems.AcquireData()
+        # only the samples since the last ones the rules read
+        self.assertEqual(
+            float(get.call_args.kwargs["params"]["start"]), self.now_ms / 1000
+        )
+
+    def test_IncrementalMissing(self):
+        response = self.export([self.now_ms], 1)
+        response.iter_lines.return_value = iter(
+            list(response.iter_lines.return_value)[1:]
+        )
+        with mock.patch.object(self.ems.session, "get", return_value=response):
+            with self.assertRaises(Exception):
+                self.ems.AcquireData()
+
+
+class TestLineProtocol(unittest.TestCase):
+    def test_Parse(self):
+        self.assertEqual(
+            ParseLineProtocol("battery,host=pi DC_V=25.1,soc=98i 1700000000000000000"),
+            ("battery", {"DC_V": 25.1, "soc": 98}, 1700000000000000000),
+        )
+
+    def test_ParseSkipped(self):
+        measurement, fields, timestamp = ParseLineProtocol(
+            'out,host=my\\ pi mode="line mode",on=t,load_watt=209'
+        )
+        self.assertEqual(measurement, "out")
+        self.assertEqual(fields, {"load_watt": 209})
+        self.assertIsNone(timestamp)
+
+    def test_ParseInvalid(self):
+        with self.assertRaises(ValueError):
+            ParseLineProtocol("battery")
+
+
+class TestEmsPush(unittest.TestCase):
+    def setUp(self):
+        self.ems = LoadEms("ems-test.conf", {"push": {"port": 0}})
+        self.server = self.ems.StartPushListener()
+        self.url = "http://{}:{}/write".format(*self.server.server_address)
+        self.now = int(datetime.now().timestamp())
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        del self.ems
+
+    def push(self, value, timestamp, groups=["battery", "pv", "out"]):
+        # fake inverter exporter
+        lines = []
+        for group in groups:
+            fields = ",".join(
+                "{}={}".format(item[len(group) + 1 :], value) for item in METRICS[group]
+            )
+            lines.append("{},host=pi {} {}".format(group, fields, timestamp))
+        return requests.post(
+            self.url, params={"precision": "s"}, data="\n".join(lines), timeout=5
+        )
+
+    def test_Push(self):
+        self.assertTrue(self.ems.local_mean)
+        with mock.patch.object(self.ems, "CheckLoads") as check:
+            self.assertEqual(self.push(1, self.now - 1, ["battery"]).status_code, 204)
+            # not every metric is known yet
+            check.assert_not_called()
+            self.assertEqual(self.push(3, self.now).status_code, 204)
+            check.assert_called_once()
+        self.assertEqual(self.ems.last_out_measurements["out_load_watt"], 3)
+        self.assertEqual(self.ems.last_out_measurements["time"], self.now)
+        self.assertEqual(self.ems.short_mean_battery_measurements["battery_DC_V"], 2)
+
+    def test_PushInvalid(self):
+        response = requests.post(self.url, data="battery", timeout=5)
+        self.assertEqual(response.status_code, 400)
+        response = requests.post(
+            self.url.replace("/write", "/query"), data="", timeout=5
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_Export(self):
+        instrumentation = Instrumentation()
+        with instrumentation.Timer("ems_query_duration_seconds", query="pv_W"):
+            pass
+        with instrumentation.Timer("ems_query_duration_seconds", query="pv_W"):
+            time.sleep(0.01)
+        instrumentation.Inc("ems_acquisition_errors_total", group="last pv")
+        text = instrumentation.Export()
+        self.assertIn("# TYPE ems_query_duration_seconds histogram", text)
+        self.assertIn(
+            'ems_query_duration_seconds_bucket{query="pv_W",le="0.001"} 1', text
+        )
+        self.assertIn(
+            'ems_query_duration_seconds_bucket{query="pv_W",le="+Inf"} 2', text
+        )
+        self.assertIn('ems_query_duration_seconds_count{query="pv_W"} 2', text)
+        self.assertIn('ems_acquisition_errors_total{group="last pv"} 1', text)
+
+    def test_EmsTimers(self):
+        ems = EMS("ems-test.conf")
+        response = mock.Mock(status_code=200)
+        response.json.return_value = {
+            "data": {"result": [{"metric": {}, "value": [1, "2"]}]}
+        }
+        with mock.patch.object(ems.session, "get", return_value=response):
+            ems.GetData()
+            # the safety tier windows are timed apart
+            ems.GetData(["last", "short"])
+        ems.StartHeater()
+        text = ems.ExportInstrumentation()
+        self.assertIn(
+            'ems_acquisition_duration_seconds_count{group="backend last+short+long"} 1',
+            text,
+        )
+        self.assertIn(
+            'ems_acquisition_duration_seconds_count{group="backend last+short"} 1',
+            text,
+        )
+        self.assertIn(
+            'ems_query_duration_seconds_count{query="avg_over_time(out_load_watt[10m])"} 1',
+            text,
+        )
+        self.assertIn(
+            'ems_relay_write_duration_seconds_count{relay="heater",state="on"} 1', text
+        )
+        self.assertIn('ems_scheduler_missed_total{tier="cycle"} 0', text)
+        self.assertIn("# TYPE ems_scheduler_missed_total counter", text)
+        self.assertIn("# TYPE ems_scheduler_jitter_max_seconds gauge", text)
+
+    def test_Endpoint(self):
+        ems = LoadEms("ems-test.conf", {"instrumentation": {"port": 0}})
+        server = ems.StartMetricsListener()
+        try:
+            response = requests.get(
+                "http://{}:{}/metrics".format(*server.server_address), timeout=5
+            )
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("ems_scheduler_cycles_total", response.text)
+
+    def test_Push(self):
+        ems = EMS("ems-test.conf")
+        with mock.patch.object(
+            ems.session, "post", return_value=mock.Mock(status_code=204)
+        ) as post:
+            self.assertTrue(ems.PushInstrumentation())
+        self.assertTrue(post.call_args.args[0].endswith("/api/v1/import/prometheus"))
+        self.assertEqual(post.call_args.kwargs["params"], {"extra_label": "job=ems"})
+
+    def test_PushPeriod(self):
+        clock = FakeClock()
+        ems = LoadEms("ems-test.conf", {"instrumentation": {"push_period": 30}}, clock)
+        with mock.patch.object(
+            ems, "PushInstrumentation", side_effect=[True, True, SystemExit]
+        ):
+            with self.assertRaises(SystemExit):
+                ems.RunInstrumentationPush()
+        # paced on the clock of the ems
+        self.assertEqual(clock.Monotonic(), 60)
+
+
+class RecordingLogger(Logger):
+    # logger writing its batches to a list, slow to write if delay is set
+    def __init__(self, *args, delay=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delay = delay
+        self.batches = []
+
+    def Emit(self, batch):
+        time.sleep(self.delay)
+        self.batches.append(batch)
+
+    def Messages(self):
+        self.Flush()
+        return [message for batch in self.batches for _, message in batch]
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "ems.journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def Ems(self, clock, **journal):
+        journal["path"] = self.path
+        return LoadEms("ems-test.conf", {"journal": journal}, clock)
+
+    def test_Restart(self):
+        clock = FakeClock()
+        ems = self.Ems(clock)
+        ems.StartHeater()
+        clock.now += 600
+        ems.StopHeater()
+        ems.heater["timer"] = clock.now
+        ems.StartHeater()
+        clock.now += 300
+        # crash while the heater runs, after a checkpoint
+        ems.loads["heater"].Record()
+        ems.journal.close()
+        del ems
+
+        # restart 60 s later, the monotonic clock starts over
+        restarted = FakeClock()
+        restarted.start = clock.Time() + 60
+        ems = self.Ems(restarted)
+        self.assertFalse(ems.heater["on"])
+        self.assertEqual(ems.heater["heating_time_counter"], 900)
+        # the heater started 360 s ago, the dwell timer goes on
+        self.assertAlmostEqual(ems.heater["timer"], -360)
+        ems.journal.close()
+
+    def test_Compact(self):
+        clock = FakeClock()
+        ems = self.Ems(clock, compact=5)
+        for _ in range(4):
+            ems.StartHeater()
+            clock.now += 10
+            ems.StopHeater()
+        ems.journal.close()
+        with open(self.path) as journal:
+            records = [json.loads(line) for line in journal]
+        self.assertLess(len(records), 5)
+        self.assertEqual(records[-1]["counter"], 40)
+
+    def test_TornRecord(self):
+        clock = FakeClock()
+        ems = self.Ems(clock)
+        ems.StartHeater()
+        clock.now += 100
+        ems.StopHeater()
+        ems.journal.close()
+        del ems
+        with open(self.path, "a") as journal:
+            journal.write('{"load": "heater", "coun')
+        ems = self.Ems(clock)
+        self.assertEqual(ems.heater["heating_time_counter"], 100)
+        ems.journal.close()
+
+
+class TestLogger(unittest.TestCase):
+    def test_Fields(self):
+        logger = RecordingLogger(Instrumentation())
+        logger.Log(syslog.LOG_INFO, "ems: start", load="heater", pv_W=1500.0)
+        self.assertEqual(logger.Messages(), ["ems: start load=heater pv_W=1500.0"])
+
+    def test_Dedup(self):
+        clock = FakeClock()
+        instrumentation = Instrumentation()
+        logger = RecordingLogger(instrumentation, interval=60, clock=clock)
+        for _ in range(3):
+            logger.Log(syslog.LOG_WARNING, "Failed to get influx data", key="cycle")
+        # unkeyed messages are never suppressed
+        logger.Log(syslog.LOG_INFO, "ems: start")
+        logger.Log(syslog.LOG_INFO, "ems: start")
+        self.assertEqual(
+            logger.Messages(),
+            ["Failed to get influx data", "ems: start", "ems: start"],
+        )
+        clock.now += 61
+        logger.Log(syslog.LOG_WARNING, "Failed to get influx data", key="cycle")
+        self.assertEqual(
+            logger.Messages()[-1], "Failed to get influx data (repeated 2 times)"
+        )
+        self.assertEqual(instrumentation.counters[("ems_log_suppressed_total", ())], 2)
+
+    def test_Bounded(self):
+        instrumentation = Instrumentation()
+        logger = RecordingLogger(instrumentation, size=2)
+        # keep the writer from draining the queue
+        with logger.writing:
+            for index in range(3):
+                logger.Log(syslog.LOG_INFO, "message {}".format(index))
+        self.assertEqual(logger.Messages(), ["message 0", "message 1"])
+        self.assertEqual(instrumentation.counters[("ems_log_dropped_total", ())], 1)
+
+    def test_NonBlocking(self):
+        logger = RecordingLogger(Instrumentation(), delay=0.2)
+        start = time.perf_counter()
+        for index in range(10):
+            logger.Log(syslog.LOG_INFO, "message {}".format(index))
+        self.assertLess(time.perf_counter() - start, 0.1)
+        self.assertEqual(len(logger.Messages()), 10)
+
+    def test_Disabled(self):
+        logger = RecordingLogger(Instrumentation(), console=False, to_syslog=False)
+        logger.Log(syslog.LOG_INFO, "ems: start")
+        self.assertEqual(logger.Messages(), [])
+        self.assertIsNone(logger.writer)
+
+
+class TestBench(unittest.TestCase):
+    def test_RequestsPerCycle(self):
+        import bench_ems
+
+        sequential = bench_ems.BenchVictoriaMetrics(3)
+        self.assertEqual(sequential["failures"], 0)
+        # 3 last values and 5 means read by the rules of the loads
+        self.assertEqual(sequential["requests_per_cycle"], 8)
+        batch = bench_ems.BenchVictoriaMetrics(3, {"batch": True})
+        self.assertEqual(batch["failures"], 0)
+        self.assertEqual(batch["requests_per_cycle"], 1)
+
+    def test_Errors(self):
+        import bench_ems
+
+        report = bench_ems.BenchVictoriaMetrics(3, {"batch": True}, error_rate=1)
+        self.assertEqual(report["failures"], 3)
+        self.assertEqual(report["server_errors"], 3)
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        try:
+            import numpy
+            import replay_ems
+        except ImportError:
+            self.skipTest("numpy is not installed")
+        self.numpy = numpy
+        self.replay = replay_ems
+
+    def test_MeanValues(self):
+        timestamps = self.numpy.arange(0, 100, 10.0)
+        values = timestamps * 2
+        times = self.numpy.array([-5, 0, 35, 95, 200])
+        means = self.replay.MeanValues((timestamps, values), times, 30)
+        self.assertTrue(self.numpy.isnan(means[0]))
+        self.assertEqual(means[1], 0)
+        # samples 10, 20, 30
+        self.assertEqual(means[2], 40)
+        self.assertEqual(means[3], 160)
+        self.assertTrue(self.numpy.isnan(means[4]))
+        last, stamps = self.replay.LastValues((timestamps, values), times)
+        self.assertEqual(last[2], 60)
+        self.assertEqual(stamps[0], 0)
+
+    def History(self, start):
+        # one sunny then one cloudy half hour
+        timestamps = start + self.numpy.arange(0, 3600, 10.0)
+        sunny = timestamps < start + 1800
+        series = {
+            item: (timestamps, self.numpy.full(len(timestamps), 1.0))
+            for group in METRICS.values()
+            for item in group
+        }
+        series["battery_DC_V"] = (timestamps, self.numpy.full(len(timestamps), 26.5))
+        series["pv_W"] = (timestamps, self.numpy.where(sunny, 800.0, 100.0))
+        series["out_load_watt"] = (timestamps, self.numpy.full(len(timestamps), 300.0))
+        return series
+
+    def test_Replay(self):
+        with open("ems-test.conf", "r") as jsonfile:
+            conf = json.load(jsonfile)
+        start = datetime.now().replace(hour=10).timestamp()
+        report = self.replay.Replay(conf, self.History(start), step=10)
+        heater = report["loads"]["heater"]
+        # the dwell timer of a fresh load expires right after startup
+        self.assertEqual(heater["timeline"][0], (start + 10, True))
+        self.assertEqual(len(heater["timeline"]), 2)
+        self.assertFalse(heater["timeline"][1][1])
+        self.assertEqual(heater["trips"], {"long": 1})
+        self.assertEqual(heater["daily"][0]["max_daily_run"], 3)
+        self.assertFalse(heater["daily"][0]["exceeded"])
+        # hydro starts with the first cloudy sample
+        hydro = report["loads"]["hydro"]
+        self.assertEqual(hydro["timeline"], [(start + 1800, True)])
+
+    def test_UnreadMetrics(self):
+        # an export without the metrics no rule reads replays the same
+        with open("ems-test.conf", "r") as jsonfile:
+            conf = json.load(jsonfile)
+        start = datetime.now().replace(hour=10).timestamp()
+        history = self.History(start)
+        for item in ["battery_charging_current", "pv_A", "out_load_percent"]:
+            del history[item]
+        report = self.replay.Replay(conf, history, step=10)
+        self.assertNotIn("deadline", report["loads"]["heater"]["trips"])
+        self.assertEqual(report["loads"]["heater"]["trips"], {"long": 1})
+
+    def test_Sweep(self):
+        import tune_ems
+
+        with open("ems-test.conf", "r") as jsonfile:
+            conf = json.load(jsonfile)
+        del conf["hydro"]
+        conf["heater"]["power"] = 400
+        start = datetime.now().replace(hour=10).timestamp()
+        parameters = {
+            "heater.on_condition.battery_voltage": [26, 27],
+            "heater.on_condition.input_power": [400, 900],
+        }
+        self.assertEqual(len(tune_ems.Grid(parameters)), 4)
+        results = tune_ems.Sweep(conf, self.History(start), parameters, 10, jobs=2)
+        self.assertEqual(len(results), 4)
+        # only a battery above 26 V and 400 W of PV start the heater
+        best = results[0]
+        self.assertEqual(
+            best["point"],
+            {
+                "heater.on_condition.battery_voltage": 26,
+                "heater.on_condition.input_power": 400,
+            },
+        )
+        self.assertGreater(best["hours"], 0)
+        self.assertAlmostEqual(best["energy"], best["hours"] * 0.4)
+        self.assertEqual(best["trips"], 1)
+        self.assertEqual(best["battery_min"], 26.5)
+        self.assertEqual(results[-1]["energy"], 0)
+        self.assertIsNone(results[-1]["battery_min"])
+
+    def test_Share(self):
+        import tune_ems
+
+        with open("ems-test.conf", "r") as jsonfile:
+            conf = json.load(jsonfile)
+        series = self.History(datetime.now().replace(hour=10).timestamp())
+        times = self.replay.Times(series, 60)
+        points = tune_ems.Grid({"mean.short": [5, 20], "heater.power": [0, 400]})
+        with tempfile.TemporaryDirectory() as directory:
+            paths, times_path = tune_ems.Share(conf, points, series, times, directory)
+            # the measurements are computed once per pair of mean windows
+            self.assertEqual(sorted(paths), [(300, 600), (1200, 600)])
+            factory = gpiozero.Device.pin_factory
+            tune_ems.Attach(conf, paths, times_path)
+            gpiozero.Device.pin_factory = factory
+            columns, rows = tune_ems.WORKER["measurements"][300, 600][
+                "short_mean_pv_measurements"
+            ]
+            self.assertIsInstance(rows, self.numpy.memmap)
+            self.assertEqual(rows.shape, (len(times), len(columns)))
+            tune_ems.WORKER.clear()
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# Sweep a grid of load thresholds over inverter history on every core and
+# rank the configs, each point is replayed as replay_ems.py does.
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import gpiozero
+from gpiozero.pins.mock import MockFactory
+
+import replay_ems
+from ems import Config
+
+# state of a worker process, set by Attach: the base conf, the replayed
+# times and the measurements of each pair of mean windows, memory mapped
+# from the files written by Share
+WORKER = {}
+
+
+def Grid(parameters):
+    # every combination of {conf path: [values]} as a list of {path: value}
+    paths = list(parameters)
+    return [
+        dict(zip(paths, values))
+        for values in itertools.product(*(parameters[path] for path in paths))
+    ]
+
+
+def Windows(conf):
+    # (short, long) seconds of the mean windows of conf
+    mean = Config(conf).mean
+    return mean["short"], mean["long"]
+
+
+def Share(conf, points, series, times, directory):
+    # compute the measurements of each pair of mean windows of the grid
+    # once and write them as .npy files the workers map instead of each
+    # computing a private copy, return the paths given to Attach
+    confs = {}
+    for point in points:
+        point_conf = Configure(conf, point)
+        confs.setdefault(Windows(point_conf), point_conf)
+    paths = {}
+    for windows, windowed in confs.items():
+        paths[windows] = {}
+        for name, (columns, rows) in replay_ems.Measurements(
+            series, times, windowed
+        ).items():
+            path = os.path.join(directory, "{}-{}.{}.npy".format(*windows, name))
+            numpy.save(path, rows)
+            paths[windows][name] = (columns, path)
+    times_path = os.path.join(directory, "times.npy")
+    numpy.save(times_path, times)
+    return paths, times_path
+
+
+def Attach(conf, paths, times_path):
+    # worker initializer, pins reserved by the parent are not ours
+    gpiozero.Device.pin_factory = MockFactory()
+    WORKER["conf"] = conf
+    WORKER["measurements"] = {
+        windows: {
+            name: (columns, numpy.load(path, mmap_mode="r"))
+            for name, (columns, path) in measurements.items()
+        }
+        for windows, measurements in paths.items()
+    }
+    WORKER["times"] = numpy.load(times_path, mmap_mode="r")
+
+
+def Configure(conf, point):
+    # copy of conf with the values of a grid point set
+    conf = json.loads(json.dumps(conf))
+    for path, value in point.items():
+        replay_ems.Override(conf, path, json.dumps(value))
+    return conf
+
+
+def Evaluate(point):
+    # replay one grid point, return its scores
+    conf = Configure(WORKER["conf"], point)
+    times = WORKER["times"]
+    step = float(times[1] - times[0]) if len(times) > 1 else 0
+    measurements = WORKER["measurements"][Windows(conf)]
+    ems, states = replay_ems.Simulate(conf, times, measurements)
+
+    running = numpy.zeros(len(times), dtype=bool)
+    energy = hours = 0
+    for name, load in ems.loads.items():
+        running |= states[name]
+        on = numpy.count_nonzero(states[name]) * step / 3600
+        hours += on
+        energy += on * load.power / 1000
+    columns, rows = measurements["last_battery_measurements"]
+    battery = rows[:, columns.index("battery_DC_V")][running]
+    battery = battery[~numpy.isnan(battery)]
+    return {
+        "point": point,
+        # kWh sent to the loads with a power rating
+        "energy": energy,
+        "hours": hours,
+        "trips": sum(
+            count
+            for trips in replay_ems.Trips(ems).values()
+            for count in trips.values()
+        ),
+        # lowest battery voltage seen while a load was running
+        "battery_min": float(battery.min()) if len(battery) else None,
+    }
+
+
+def Rank(results):
+    # most energy first, then fewer trips and the highest battery minimum,
+    # running hours stand for energy when no load has a power rating
+    def Key(result):
+        battery_min = result["battery_min"]
+        return (
+            -result["energy"],
+            -result["hours"],
+            result["trips"],
+            -(battery_min if battery_min is not None else float("inf")),
+        )
+
+    return sorted(results, key=Key)
+
+
+def Sweep(conf, series, parameters, step=60, jobs=None):
+    # replay every point of the parameters grid in a process pool
+    points = Grid(parameters)
+    times = replay_ems.Times(series, step)
+    jobs = jobs or os.cpu_count()
+    with tempfile.TemporaryDirectory() as directory:
+        paths, times_path = Share(conf, points, series, times, directory)
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=Attach,
+            initargs=(conf, paths, times_path),
+        ) as pool:
+            results = list(
+                pool.map(Evaluate, points, chunksize=max(1, len(points) // (jobs * 4)))
+            )
+    return Rank(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--conf", required=True)
+    parser.add_argument(
+        "-i",
+        "--input",
+        required=True,
+        help="VictoriaMetrics export, JSON lines or .csv",
+    )
+    parser.add_argument(
+        "-g", "--grid", help='JSON file of {"conf.path": [values]} to sweep'
+    )
+    parser.add_argument(
+        "-p",
+        "--param",
+        action="append",
+        default=[],
+        metavar="PATH=V1,V2",
+        help="values of a conf path, e.g. heater.on_condition.battery_voltage=26,26.5",
+    )
+    parser.add_argument(
+        "--step", type=float, default=60, help="seconds between two checks"
+    )
+    parser.add_argument("-j", "--jobs", type=int, help="worker processes")
+    parser.add_argument("-n", "--top", type=int, default=10)
+    parser.add_argument("-o", "--output", help="write every result to this csv")
+    args = parser.parse_args()
+
+    with open(args.conf, "r") as jsonfile:
+        conf = json.load(jsonfile)
+    parameters = {}
+    if args.grid:
+        with open(args.grid, "r") as jsonfile:
+            parameters.update(json.load(jsonfile))
+    for param in args.param:
+        path, values = param.split("=", 1)
+        parameters[path] = [json.loads(value) for value in values.split(",")]
+    if not parameters:
+        parser.error("no parameter to sweep")
+
+    results = Sweep(
+        conf, replay_ems.LoadSeries(args.input), parameters, args.step, args.jobs
+    )
+    if args.output:
+        with open(args.output, "w", newline="") as output:
+            writer = csv.writer(output)
+            writer.writerow(
+                ["rank"]
+                + list(parameters)
+                + ["energy", "hours", "trips", "battery_min"]
+            )
+            for rank, result in enumerate(results, 1):
+                writer.writerow(
+                    [rank]
+                    + [result["point"][path] for path in parameters]
+                    + [
+                        result["energy"],
+                        result["hours"],
+                        result["trips"],
+                        result["battery_min"],
+                    ]
+                )
+    for rank, result in enumerate(results[: args.top], 1):
+        print(
+            "{:>3} {:>8.2f} kWh {:>8.2f} h {:>5} trips  battery min {}  {}".format(
+                rank,
+                result["energy"],
+                result["hours"],
+                result["trips"],
+                result["battery_min"],
+                json.dumps(result["point"], sort_keys=True),
+            )
+        )